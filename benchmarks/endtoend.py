@@ -0,0 +1,291 @@
+"""
+End-to-end benchmarks against a local stand-in for the StudentRecord.com API
+(see mockserver.py).
+
+    python benchmarks/endtoend.py                     # every scenario
+    python benchmarks/endtoend.py scan csv_import --rows 100000
+    python benchmarks/endtoend.py --latency 0.02 --error-rate 0.001
+
+Scenarios:
+
+* scan: iterate every applicant
+* csv_import: import synthetic CSV rows with examples/csv_import.yaml
+* export_resolve: resolve every applicant's people, schools and employers
+  one request at a time, as examples/matchbox_export.py does
+
+Each scenario reports its throughput, the number of requests it made (and
+how many of them failed), their p50/p99 latency, and the bytes transferred
+(with --compress, both on the wire and uncompressed).  With --error-rate,
+scan and export_resolve retry failed requests; csv_import carries on past
+them, as the importer does.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import time
+from cStringIO import StringIO
+
+# run from a checkout, without installing the package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import studentrecord  # noqa
+from studentrecord import config  # noqa
+from studentrecord.importer import Importer  # noqa
+
+from mockserver import MockServer
+
+CONFIG = os.path.join(os.path.dirname(__file__), os.pardir, 'examples',
+                      'csv_import.yaml')
+
+
+def load_mappings(filename=CONFIG):
+    with open(filename) as f:
+        return config.load_mappings(f)
+
+
+def synthetic_rows(count, seed=0):
+    """
+    Yields CSV-style rows with the columns used by examples/csv_import.yaml.
+    Schools, employers and parents repeat between rows, as they do in real
+    exports.
+    """
+    rnd = random.Random(seed)
+    for i in xrange(count):
+        school = rnd.randrange(max(count // 20, 1))
+        yield {
+            'SSN Combined': '%09i' % i,
+            'First Name': 'First%i' % i,
+            'Middle Name': 'M',
+            'Last Name': 'Last%i' % rnd.randrange(1000),
+            'Sex': rnd.choice(['M', 'F']),
+            'Email': 'applicant%i@example.com' % i,
+            'Date of Birth': '1995-%02i-%02i' % (rnd.randint(1, 12),
+                                                 rnd.randint(1, 28)),
+            'Perm Address1': '%i Main St' % rnd.randrange(1000),
+            'Perm City': 'Boston',
+            'Perm State': 'MA',
+            'Perm Country': 'USA',
+            'Perm Zip/Postal Code': '02%03i' % rnd.randrange(1000),
+            'Citizenship Status': 'US Citizen',
+            'Sec School/College CEEB Code': '%06i' % school,
+            'Sec School/College Name': 'High School %i' % school,
+            'Sec School/College Type': 'Public',
+            'Sec School/College City': 'Boston',
+            'Sec School/College State': 'MA',
+            'Sec School/College Country': 'USA',
+            'Sec School/College Date of Entry': '2009-09-01',
+            'Class Rank': str(rnd.randrange(1, 400)),
+            'Graduating Class Size': '400',
+            'Parent 1 Title': 'Ms.',
+            'Parent 1 First Name': 'Parent%i' % i,
+            'Parent 1 Last Name': 'Last%i' % i,
+            'Parent 1 Employer': 'Employer %i' % rnd.randrange(200),
+            'Parent 1 Position/Title': 'Engineer',
+            'Parent 1 Type': 'Mother',
+            'Parents Marital Status': 'Married',
+            'Counselor/Advisor First Name': 'Counselor',
+            'Counselor/Advisor Last Name': 'School %i' % school,
+        }
+
+
+def synthetic_csv(count, seed=0):
+    """
+    Returns the synthetic rows as a CSV file in memory.
+    """
+    rows = iter(synthetic_rows(count, seed))
+    first = next(rows)
+    f = StringIO()
+    writer = csv.DictWriter(f, sorted(first))
+    writer.writeheader()
+    writer.writerow(first)
+    writer.writerows(rows)
+    f.seek(0)
+    return f
+
+
+def synthetic_applicants(server, count, seed=0):
+    """
+    Seeds the server with applicants (and the people, schools and
+    organizations they refer to) for the scan and export scenarios.
+    """
+    rnd = random.Random(seed)
+    schools = server.seed('school', [
+        dict(name='High School %i' % i, ceeb='%06i' % i,
+             location=dict(city='Boston', state='MA', country='USA'))
+        for i in range(max(count // 20, 1))])
+    orgs = server.seed('organization', [
+        dict(name='Employer %i' % i) for i in range(200)])
+    applicants = []
+    for i in xrange(count):
+        parent = server.seed('person', [dict(
+            name=dict(prefix='Ms.', first='Parent%i' % i, middle='',
+                      last='Last%i' % i, suffix=''),
+            job=[dict(organization=rnd.choice(orgs)['id'],
+                      title='Engineer', start='1970-01-01')])])[0]
+        applicants.append(dict(
+            name=dict(prefix='', first='First%i' % i, middle='M',
+                      last='Last%i' % i, suffix=''),
+            key=dict(ssn='%09i' % i, email='applicant%i@example.com' % i),
+            gender=rnd.choice(['M', 'F']),
+            birth=dict(date='1995-01-01', location=dict(
+                city='Boston', state='MA', country='USA')),
+            family=[dict(person=parent['id'], relationship=['Mother'],
+                         start='1995-01-01')],
+            schools=[dict(school=rnd.choice(schools)['id'], degree='HS',
+                          start='2009-09-01', counselor=None, rank=10,
+                          size=400)],
+            job=[]))
+    server.seed('applicant', applicants)
+
+
+class Retrying(studentrecord.BaseClient):
+    """
+    Sends requests through `client`, trying each one up to `attempts` times
+    if the server fails.
+    """
+    __slots__ = ('client', 'attempts')
+
+    def __init__(self, client, attempts=10):
+        self.client = client
+        self.attempts = attempts
+
+    def dispatch(self, method, endpoint, _id=None, **kwargs):
+        for attempt in range(self.attempts):
+            try:
+                return self.client.dispatch(method, endpoint, _id, **kwargs)
+            except (studentrecord.LoginException, studentrecord.NotFound):
+                raise
+            except studentrecord.StudentRecordException:
+                if attempt == self.attempts - 1:
+                    raise
+
+
+def scenario_scan(server, sr, args):
+    synthetic_applicants(server, args.rows)
+    sr = Retrying(sr)
+    start = time.time()
+    count = sum(1 for _ in sr['applicant'])
+    return count, time.time() - start
+
+
+def scenario_csv_import(server, sr, args):
+    data = synthetic_csv(args.rows)
+    importer = Importer(sr, load_mappings())
+    start = time.time()
+    importer(csv.DictReader(data))
+    return args.rows, time.time() - start
+
+
+def scenario_export_resolve(server, sr, args):
+    synthetic_applicants(server, args.rows)
+    sr = Retrying(sr)
+    start = time.time()
+    cache = {}
+
+    def resolve(type_, _id):
+        if (type_, _id) not in cache:
+            cache[type_, _id] = sr[type_][_id]
+        return cache[type_, _id]
+
+    count = 0
+    for applicant in sr['applicant']:
+        for family in applicant['family']:
+            family['person'] = resolve('person', family['person'])
+        for school in applicant['schools']:
+            school['school'] = resolve('school', school['school'])
+            if school['counselor']:
+                school['counselor'] = resolve('person', school['counselor'])
+        for job in applicant['job']:
+            job['organization'] = resolve('organization', job['organization'])
+        count += 1
+    return count, time.time() - start
+
+
+SCENARIOS = [
+    ('scan', scenario_scan),
+    ('csv_import', scenario_csv_import),
+    ('export_resolve', scenario_export_resolve),
+]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def run(name, scenario, args):
+    server = MockServer(latency=args.latency, error_rate=args.error_rate,
+                        compress=args.compress)
+    server.start()
+    try:
+        sr = server.client(compress_requests=args.compress)
+        sr.choose_customer(server.customer)
+        latencies = []
+        transferred = [0, 0]
+        failed = []
+
+        def record(info):
+            latencies.append(info['seconds'])
+            if info['status'] != 200:
+                failed.append(info['status'])
+            transferred[0] += info['bytes_sent'] + info['bytes_received']
+            transferred[1] += (info['uncompressed_bytes_sent'] +
+                               info['uncompressed_bytes_received'])
+        sr.add_hook('post_request', record)
+        items, seconds = scenario(server, sr, args)
+    finally:
+        server.stop()
+    return dict(
+        scenario=name,
+        items=items,
+        seconds=seconds,
+        items_per_second=items / seconds if seconds else 0.0,
+        requests=len(latencies),
+        failed=len(failed),
+        p50=percentile(latencies, 50),
+        p99=percentile(latencies, 99),
+        bytes=transferred[0],
+        uncompressed_bytes=transferred[1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('scenario', nargs='*',
+                        help='Scenarios to run: %s (default: all)' % (
+                            ', '.join(name for (name, _) in SCENARIOS)))
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='Rows/applicants per scenario (default 10000)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds of latency added to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests which fail with a 500')
+    parser.add_argument('--compress', action='store_true',
+                        help='Gzip request and response bodies')
+    parser.add_argument('--json', metavar='FILENAME',
+                        type=argparse.FileType('w'),
+                        help='Also write the results to FILENAME as JSON')
+    args = parser.parse_args()
+    unknown = set(args.scenario) - set(name for (name, _) in SCENARIOS)
+    if unknown:
+        parser.error('unknown scenario: %s' % ', '.join(sorted(unknown)))
+
+    results = []
+    print '%-16s %9s %9s %11s %9s %9s %9s %9s %9s %9s' % (
+        'scenario', 'items', 'seconds', 'items/sec', 'requests', 'failed',
+        'p50 ms', 'p99 ms', 'wire KB', 'raw KB')
+    for name, scenario in SCENARIOS:
+        if args.scenario and name not in args.scenario:
+            continue
+        r = run(name, scenario, args)
+        results.append(r)
+        print '%-16s %9i %9.2f %11.1f %9i %9i %9.2f %9.2f %9i %9i' % (
+            name, r['items'], r['seconds'], r['items_per_second'],
+            r['requests'], r['failed'], r['p50'] * 1000, r['p99'] * 1000,
+            r['bytes'] // 1024, r['uncompressed_bytes'] // 1024)
+        sys.stdout.flush()
+    if args.json:
+        json.dump(results, args.json, indent=2)
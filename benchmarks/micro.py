@@ -0,0 +1,228 @@
+"""
+Micro-benchmarks for the CPU-bound paths run for every object of every row:
+`Mapping` rendering, `Importer.dict_to_query`, `Importer.get_update` and
+`dict_diff` from examples/matchbox_export.py.
+
+    python benchmarks/micro.py                  # just the timings
+    python benchmarks/micro.py --save           # store them as a baseline
+    python benchmarks/micro.py --compare --threshold 10
+
+Timings depend on the machine, so no baseline is kept in the repository:
+save one (before a change) on the machine doing the comparing.  With
+`--compare`, the exit status is 1 if any path is more than `--threshold`
+percent slower than its baseline.
+
+Each path is timed over the objects of 1000 rows, with the garbage
+collector off (as `timeit` does).  The runs of the different paths are
+interleaved, and repeated in `--processes` fresh processes, since the
+speed of a process varies (by 20% or more on shared or virtual machines);
+the best time of each path is kept.  The spread between the processes is
+reported as the noise, and a path only counts as a regression if it's
+slower by more than the threshold and by more than the noise of both runs
+put together.
+
+Allocations (the number of memory blocks and bytes still allocated after
+one call, and the peak) need tracemalloc: Python 3, or a Python 2 patched
+for pytracemalloc.  Without it they aren't reported.
+"""
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+from timeit import default_timer
+
+# run from a checkout, without installing the package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from studentrecord.importer import Importer  # noqa
+
+from endtoend import load_mappings, synthetic_rows
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'examples'))
+from matchbox_export import dict_diff  # noqa
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'micro_baseline.json')
+ROWS = 1000
+
+
+def setup():
+    """
+    Builds the inputs for each path from synthetic rows: the rendered
+    objects, and versions of them as the API would return them (with IDs,
+    and with some values changed).
+    """
+    mappings = load_mappings()
+    importer = Importer(None, mappings)
+    rows = list(synthetic_rows(ROWS))
+    pairs = [(mapping, row) for row in rows for (_, ms) in mappings
+             for mapping in ms]
+    objects = [o for o in (mapping(row) for (mapping, row) in pairs) if o]
+    existing = []
+    for i, obj in enumerate(objects):
+        old = json.loads(json.dumps(obj))
+        old['id'] = str(i)
+        if i % 3 == 0 and isinstance(old.get('name'), dict):
+            old['name']['last'] = 'Changed'
+        existing.append(old)
+    return dict(importer=importer, pairs=pairs, objects=objects,
+                existing=existing)
+
+
+def bench_mapping(data):
+    for mapping, row in data['pairs']:
+        mapping(row)
+    return len(data['pairs'])
+
+
+def bench_dict_to_query(data):
+    dict_to_query = data['importer'].dict_to_query
+    for obj in data['objects']:
+        dict_to_query(obj)
+    return len(data['objects'])
+
+
+def bench_get_update(data):
+    get_update = data['importer'].get_update
+    for old, new in zip(data['existing'], data['objects']):
+        get_update(old, new)
+    return len(data['objects'])
+
+
+def bench_dict_diff(data):
+    for old, new in zip(data['existing'], data['objects']):
+        dict_diff(new, old)
+    return len(data['objects'])
+
+
+BENCHMARKS = [
+    ('mapping', bench_mapping),
+    ('dict_to_query', bench_dict_to_query),
+    ('get_update', bench_get_update),
+    ('dict_diff', bench_dict_diff),
+]
+
+
+def timings(benchmarks, data, repeat):
+    """
+    Returns the best time per call (in microseconds) of each benchmark
+    over `repeat` rounds, each of which runs every benchmark once.
+    """
+    best = {}
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            for name, func in benchmarks:
+                start = default_timer()
+                calls = func(data)
+                elapsed = (default_timer() - start) / calls * 1e6
+                best[name] = min(best.get(name, elapsed), elapsed)
+    finally:
+        if enabled:
+            gc.enable()
+    return best
+
+
+def allocations(func, data):
+    """
+    Returns a dictionary describing the allocations per call of `func`.
+    Needs tracemalloc.
+    """
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    calls = func(data)
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    return dict(
+        blocks=float(sum(s.count_diff for s in stats)) / calls,
+        bytes=float(sum(s.size_diff for s in stats)) / calls,
+        peak_bytes=peak)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--save', action='store_true',
+                        help='Store the results as the new baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='Compare with the stored baseline')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='Baseline file (default %(default)s)')
+    parser.add_argument('--threshold', type=float, default=20.0,
+                        help='Percent slowdown which counts as a '
+                        'regression (default %(default)s)')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Runs of each path per process (default '
+                        '%(default)s)')
+    parser.add_argument('--processes', type=int, default=3,
+                        help='Processes to time the paths in (default '
+                        '%(default)s)')
+    parser.add_argument('--worker', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    data = setup()
+    if args.worker:
+        # time the paths in this process, for the parent
+        json.dump(timings(BENCHMARKS, data, args.repeat), sys.stdout)
+        sys.exit(0)
+    baseline = {}
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            parser.error('no baseline at %s; save one with --save' %
+                         args.baseline)
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    runs = {}
+    for _ in range(args.processes):
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--worker', '--repeat',
+             str(args.repeat)])
+        for name, us in json.loads(output).iteritems():
+            runs.setdefault(name, []).append(us)
+    print '%-14s %12s %7s %12s %9s  %s' % (
+        'path', 'us/call', 'noise', 'baseline', 'change',
+        'allocations/call' if tracemalloc else '')
+    for name, func in BENCHMARKS:
+        us = min(runs[name])
+        noise = 100.0 * (max(runs[name]) - us) / us
+        results[name] = dict(us_per_call=us, noise=noise)
+        allocs = {}
+        if tracemalloc is not None:
+            allocs = results[name]['allocations'] = allocations(func, data)
+        old = baseline.get(name, {}).get('us_per_call')
+        if old:
+            change = 100.0 * (us - old) / old
+            if change > max(args.threshold,
+                            noise + baseline[name].get('noise', 0)):
+                regressions.append(name)
+            compared = '%12.2f %+8.1f%%' % (old, change)
+        else:
+            compared = '%12s %9s' % ('-', '-')
+        print '%-14s %12.2f %6.1f%% %s  %s' % (
+            name, us, noise, compared,
+            ', '.join('%s=%.1f' % i for i in sorted(allocs.iteritems())))
+    if tracemalloc is None:
+        print ("(allocations aren't measured: they need tracemalloc, which "
+               "Python 2 only has with pytracemalloc)")
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print 'saved baseline to', args.baseline
+    elif regressions:
+        print 'REGRESSION (more than %g%% and the noise slower): %s' % (
+            args.threshold, ', '.join(regressions))
+        sys.exit(1)
@@ -0,0 +1,255 @@
+"""
+A local stand-in for the StudentRecord.com API, for benchmarking.
+
+It implements login, the customer list and the
+`/api/v1/<customer>/<endpoint>/[<id>/]` routes (paging with
+`_skip`/`_limit`, `_fields`, `field__sub` filters, and create, read, update
+and delete), keeping everything in memory.  Latency and errors can be
+injected:
+
+>>> server = MockServer(latency=0.02, error_rate=0.01)
+>>> server.start()
+>>> sr = server.client()
+>>> sr.choose_customer(server.customer)
+>>> server.stop()
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import random
+import threading
+import time
+import urlparse
+import zlib
+from collections import OrderedDict, defaultdict
+from itertools import count
+
+import studentrecord
+
+TOKEN = 'benchmark-token'
+
+
+def flatten(o, prefix=''):
+    if isinstance(o, dict):
+        for k, v in o.iteritems():
+            for item in flatten(v, '%s__%s' % (prefix, k) if prefix else k):
+                yield item
+    elif isinstance(o, list):
+        for v in o:
+            for item in flatten(v, prefix):
+                yield item
+    elif o is not None:
+        yield prefix, unicode(o)
+
+
+class Store(object):
+    """
+    The in-memory data: {customer: {endpoint: OrderedDict(id: object)}}.
+    Objects are indexed by each of their flattened (field, value) pairs, so
+    filtering doesn't slow down as the store grows; change them through
+    `update()` and `delete()` to keep the index up to date.
+    """
+
+    def __init__(self, customers):
+        self.lock = threading.Lock()
+        self.ids = count(1)
+        self.customers = [dict(id=c, name='Customer %s' % c)
+                          for c in customers]
+        self.data = dict((c, {}) for c in customers)
+        # (customer, endpoint) -> {(field, value): set of IDs}
+        self.index = defaultdict(lambda: defaultdict(set))
+
+    def objects(self, customer, endpoint):
+        return self.data[customer].setdefault(endpoint, OrderedDict())
+
+    def _index(self, customer, endpoint, obj, add=True):
+        index = self.index[customer, endpoint]
+        for pair in set(flatten(obj)):
+            if add:
+                index[pair].add(obj['id'])
+            else:
+                index[pair].discard(obj['id'])
+
+    def create(self, customer, endpoint, obj):
+        with self.lock:
+            obj['id'] = unicode(next(self.ids))
+            self.objects(customer, endpoint)[obj['id']] = obj
+            self._index(customer, endpoint, obj)
+        return obj
+
+    def update(self, customer, endpoint, _id, data):
+        with self.lock:
+            obj = self.objects(customer, endpoint)[_id]
+            self._index(customer, endpoint, obj, add=False)
+            obj.update(data)
+            self._index(customer, endpoint, obj)
+        return obj
+
+    def delete(self, customer, endpoint, _id):
+        with self.lock:
+            obj = self.objects(customer, endpoint).pop(_id)
+            self._index(customer, endpoint, obj, add=False)
+
+    def query(self, customer, endpoint, filters):
+        with self.lock:
+            objects = self.objects(customer, endpoint)
+            if not filters:
+                return objects.values()
+            index = self.index[customer, endpoint]
+            matches = None
+            for pair in filters.iteritems():
+                ids = index.get(pair)
+                if not ids:
+                    return []
+                matches = set(ids) if matches is None else matches & ids
+                if not matches:
+                    return []
+            # IDs count up, so this is the order they were created in
+            return [objects[i] for i in sorted(matches, key=int)]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately; don't wait on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, data=None):
+        body = json.dumps(data) if data is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if (body and self.server.compress and
+                'gzip' in self.headers.get('Accept-Encoding', '')):
+            body = studentrecord.gzip(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def handle_request(self, method):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        body = self.read_body()
+        url = urlparse.urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p][2:]  # skip api/v1
+        if random.random() < server.error_rate:
+            return self.respond(500, {'error': 'injected error'})
+        if parts == ['login']:
+            return self.respond(200, {'authentication_token': TOKEN})
+        if self.headers.get('Authentication-Token') != TOKEN:
+            return self.respond(401, {'error': 'unauthorized'})
+        if parts == ['customer']:
+            return self.respond(200, {'data': server.store.customers,
+                                      'has_more': False})
+        if len(parts) not in (2, 3) or parts[0] not in server.store.data:
+            return self.respond(404, {'error': 'not found'})
+        customer, endpoint = parts[:2]
+        objects = server.store.objects(customer, endpoint)
+        if len(parts) == 3:
+            _id = parts[2]
+            if _id not in objects:
+                return self.respond(404, {'error': 'not found'})
+            if method == 'GET':
+                return self.respond(200, objects[_id])
+            elif method == 'PUT':
+                return self.respond(200, server.store.update(
+                    customer, endpoint, _id, json.loads(body)))
+            elif method == 'DELETE':
+                server.store.delete(customer, endpoint, _id)
+                return self.respond(200, {})
+        elif method == 'GET':
+            args = dict((k, v[-1]) for (k, v) in
+                        urlparse.parse_qs(url.query).iteritems())
+            skip = int(args.pop('_skip', 0))
+            limit = min(int(args.pop('_limit', 100)), server.page_limit)
+            fields = args.pop('_fields', None)
+            filters = dict((k.decode('utf-8'), v.decode('utf-8'))
+                           for (k, v) in args.iteritems())
+            matches = server.store.query(customer, endpoint, filters)
+            page = matches[skip:skip + limit]
+            if fields:
+                fields = fields.split(',')
+                page = [dict((f, o.get(f)) for f in fields) for o in page]
+            return self.respond(200, {'data': page,
+                                      'has_more': skip + limit < len(matches)})
+        elif method == 'POST':
+            return self.respond(200, server.store.create(
+                customer, endpoint, json.loads(body)))
+        return self.respond(405, {'error': 'method not allowed'})
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class MockServer(object):
+    """
+    Runs the stand-in API on a local port, in a background thread.  Each
+    request waits `latency` seconds, and fails with a 500 with probability
+    `error_rate`.  With `compress`, responses are gzipped for clients which
+    accept it.
+    """
+
+    def __init__(self, latency=0, error_rate=0, page_limit=1000,
+                 customers=('customer1',), compress=False):
+        self.compress = compress
+        self.latency = latency
+        self.error_rate = error_rate
+        self.page_limit = page_limit
+        self.store = Store(customers)
+        self.customer = customers[0]
+        self.httpd = None
+
+    def start(self, port=0):
+        self.httpd = HTTPServer(('127.0.0.1', port), Handler)
+        for attr in ('latency', 'error_rate', 'page_limit', 'store',
+                     'compress'):
+            setattr(self.httpd, attr, getattr(self, attr))
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @property
+    def host(self):
+        return '%s:%i' % self.httpd.server_address
+
+    def client(self, **kwargs):
+        """
+        Returns a `StudentRecord` object pointed at this server.
+        """
+        return studentrecord.StudentRecord(('user@example.com', 'password'),
+                                           scheme='http', host=self.host,
+                                           **kwargs)
+
+    def seed(self, endpoint, objects, customer=None):
+        """
+        Adds objects directly to the store; returns them with their IDs.
+        """
+        return [self.store.create(customer or self.customer, endpoint, o)
+                for o in objects]
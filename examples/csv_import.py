@@ -17,21 +17,27 @@ sets of data.
 import argparse
 import logging
 import codecs
+import cPickle as pickle
+import os
+import shutil
+import tempfile
 import studentrecord
-from studentrecord.mapping import Mapping
-from studentrecord.importer import Importer
+from studentrecord import config
+from studentrecord.importer import CACHE_SIZE, Importer
+from studentrecord.memory import MemoryMonitor
+from studentrecord.outcomes import Outcomes
+from studentrecord.planner import Planner
+from studentrecord.profiling import Profile
+from studentrecord.sharding import ShardedImporter, coordinator
 import sys
 import csv
-import yaml
+import time
+from collections import OrderedDict
 from itertools import izip, repeat
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
-try:
-    import chardet
-except:
-    chardet = None
 
 
 class GetSupportingDefaultDict(dict):
@@ -53,6 +59,160 @@ def build_row((importer, level, row)):
     importer(row)
 
 
+def import_shard(importer, level, rows):
+    """
+    Runs one shard of a `--shards` import in a child process.  The importer
+    is pickled so that the child gets its own connections to the API.
+    """
+    importer = pickle.loads(importer)
+    importer.logger = logging.getLogger(importer.log_name)
+    importer.logger.setLevel(level)
+    importer(rows)
+
+
+def wait_for_shards(processes, poll=0.1):
+    """
+    Waits for the processes of a `--shards` import to finish.  If one of
+    them fails, the others would wait for each of the IDs it owns until
+    they time out, so they're terminated.  Returns the numbers of the
+    shards which failed, and of those which were terminated.
+    """
+    stopped = []
+    while any(p.is_alive() for p in processes):
+        if any(p.exitcode for p in processes):
+            for i, p in enumerate(processes):
+                if p.is_alive():
+                    p.terminate()
+                    stopped.append(i)
+            break
+        time.sleep(poll)
+    for p in processes:
+        p.join()
+    failed = [i for (i, p) in enumerate(processes)
+              if p.exitcode and i not in stopped]
+    return failed, stopped
+
+
+def detect_encoding(prefix):
+    """
+    Guesses the encoding of a file from its first bytes with chardet,
+    stopping as soon as chardet is sure.  Returns None if chardet isn't
+    installed or can't tell.
+    """
+    try:
+        from chardet.universaldetector import UniversalDetector
+    except ImportError:
+        return None
+    detector = UniversalDetector()
+    for i in xrange(0, len(prefix), 64 * 1024):
+        detector.feed(prefix[i:i + 64 * 1024])
+        if detector.done:
+            break
+    detector.close()
+    return detector.result['encoding']
+
+
+def read_csv(f, encoding=None):
+    """
+    Reads a whole CSV file, returning its encoding and a `csv.DictReader`
+    over its rows (re-encoded as UTF-8).  Unless `encoding` is given, it's
+    detected from the first megabyte, and stdin is assumed to be UTF-8.
+    """
+    data = f.read()
+    prefix = data[:1024 ** 2]
+    if encoding is None:
+        encoding = 'UTF-8'
+        if f is not sys.stdin:
+            encoding = detect_encoding(prefix) or encoding
+    dialect = csv.Sniffer().sniff(prefix, delimiters=',\t')
+    lines = StringIO(data)
+    if codecs.lookup(encoding).name != 'utf-8':
+        lines = codecs.iterencode(codecs.iterdecode(lines, encoding), 'utf-8')
+    return encoding, csv.DictReader(lines, dialect=dialect)
+
+
+class FileStats(object):
+    """
+    Progress of one file in a multi-file import.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.done = 0
+        self.first = None
+        self.last = None
+
+    def row_done(self, now):
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.done += 1
+
+    @property
+    def elapsed(self):
+        if self.first is None:
+            return 0.0
+        return self.last - self.first
+
+
+def import_files(importer, files, threads, encoding=None, quiet=0,
+                 progress_every=1000):
+    """
+    Imports several files at once with a pool of `threads` threads: the
+    files are read and their encodings detected in parallel, then every
+    row of every file goes through the same pool and the same (coalescing)
+    `importer`, so objects found through one file are reused by the
+    others.  Prints progress every `progress_every` rows, and a summary of
+    each file at the end; returns the `FileStats` for each file.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    def load(f):
+        return f, read_csv(f, encoding)
+
+    def import_row((stats, row)):
+        importer(row)
+        return stats
+
+    start = time.time()
+    pool = ThreadPool(threads)
+    try:
+        readers = OrderedDict()
+        for f, (file_encoding, reader) in pool.imap(load, files):
+            name = getattr(f, 'name', '<stdin>')
+            readers[FileStats(name)] = reader = list(reader)
+            if quiet < 2:
+                print 'Read %s (as %s, %i rows)' % (name, file_encoding,
+                                                     len(reader))
+        rows = []
+        for stats, reader in readers.iteritems():
+            rows.extend(izip(repeat(stats), reader))
+        total = len(rows)
+        done = 0
+        for stats in pool.imap_unordered(import_row, rows):
+            now = time.time()
+            stats.row_done(now)
+            done += 1
+            if quiet < 2 and not done % progress_every:
+                print '%i/%i rows (%.1f rows/s)' % (
+                    done, total, done / (now - start))
+        importer.flush(pool)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    if quiet < 2:
+        print
+        print '%-40s %9s %9s %9s' % ('file', 'rows', 'seconds', 'rows/s')
+        for stats in readers:
+            print '%-40s %9i %9.1f %9.1f' % (
+                stats.name[-40:], stats.done, stats.elapsed,
+                stats.done / stats.elapsed if stats.elapsed else 0)
+        print '%-40s %9i %9.1f %9.1f' % (
+            'total', done, elapsed, done / elapsed if elapsed else 0)
+    return list(readers)
+
+
 if __name__ == "__main__":
     def validate_srdc_auth(value):
         if ':' in value:
@@ -64,6 +224,27 @@ if __name__ == "__main__":
         description='Upload a CSV file to StudentRecord.com.')
     parser.add_argument('-m', dest='multiprocessing', action='store_true',
                         help='Use multiple processes to speed up the import')
+    parser.add_argument(
+        '-j', '--threads', type=int, default=None, metavar='N',
+        help='Import all the files at once with N threads, sharing lookups '
+        'between them (implies --coalesce; not available with -m)')
+    parser.add_argument(
+        '--shard', metavar='I/N',
+        help='Only write the objects belonging to shard I of N (counting '
+        'from 0); run the other shards in other processes or on other hosts, '
+        'with the same files and --coordination')
+    parser.add_argument(
+        '--coordination', metavar='FILENAME|tcp://HOST:PORT',
+        help='With --shard, where the shards share the IDs they create: a '
+        'SQLite file, or a server started with `python -m '
+        'studentrecord.sharding HOST:PORT`')
+    parser.add_argument(
+        '--shards', type=int, metavar='N',
+        help='Import with N local processes, each owning a shard of the '
+        'objects (not available with -m or -j)')
+    parser.add_argument(
+        '--encoding',
+        help="The files' encoding (by default it's detected with chardet)")
     parser.add_argument(
         '-q', dest='quiet', action='append_const', const=True,
         help="-q: only display errors; -qq: don't display anything")
@@ -76,7 +257,57 @@ if __name__ == "__main__":
         '--dry-run', action='store_true',
         help="""Don't import anything; just check the YAML file.
 If CSV files are present, the headers will be scanned and a report of \
-used/unused fields will be printed.""")
+used/unused fields will be printed, along with an estimate of the requests \
+and time the import would take.""")
+    parser.add_argument(
+        '--cache-dir', default=config.DEFAULT_CACHE_DIR, metavar='DIR',
+        help='Where to cache the parsed configuration (default %(default)s)')
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help="Don't cache the parsed configuration")
+    parser.add_argument(
+        '--latency', type=float, default=100, metavar='MS',
+        help='With --dry-run, the expected time per request in milliseconds '
+        '(default %(default)s)')
+    parser.add_argument(
+        '--concurrency', type=int, default=None, metavar='N',
+        help='With --dry-run, the number of requests expected to run at once '
+        '(default: the number of CPUs with -m, N with -j, otherwise 1)')
+    parser.add_argument(
+        '--coalesce', action='store_true',
+        help='Look up each object once, and write objects which appear in '
+        'many rows once per chunk (not available with -m)')
+    parser.add_argument(
+        '--chunk-size', type=int, default=1000, metavar='N',
+        help='With --coalesce, write pending updates once N objects have '
+        'them (default %(default)s)')
+    parser.add_argument(
+        '--cache-size', type=int, default=CACHE_SIZE, metavar='N',
+        help='With --coalesce, remember the N most recently used objects '
+        'rather than looking them up again (default %(default)s)')
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Print a breakdown of where the import spent its time (not '
+        'available with -m)')
+    parser.add_argument(
+        '--profile-json', metavar='FILENAME', type=argparse.FileType('w'),
+        help='Also write the profile to FILENAME as JSON')
+    parser.add_argument(
+        '--outcomes', metavar='FILENAME', type=argparse.FileType('w'),
+        help='Write what happened to each object to FILENAME, one JSON '
+        'object per line (not available with -m)')
+    parser.add_argument(
+        '--sample-no-change', type=float, default=1.0, metavar='FRACTION',
+        help="With --outcomes, only write this fraction of the objects "
+        "which didn't change (default %(default)s)")
+    parser.add_argument(
+        '--memory', type=float, nargs='?', const=60, metavar='SECONDS',
+        help='Log the memory use of this process (and where it grew) every '
+        'SECONDS seconds (default 60), and summarize it at the end')
+    parser.add_argument(
+        '--memory-limit', type=float, metavar='MB',
+        help='With --memory, log a warning whenever the memory use is over '
+        'MB megabytes')
     parser.add_argument(
         '-c', '--customer', help='Customer ID to push to on StudentRecord.com',
         metavar='CUSTOMER')
@@ -86,9 +317,47 @@ used/unused fields will be printed.""")
         'csv_file', nargs='*', type=argparse.FileType('rb'),
         help='CSV files to upload. If none are specified, read from stdin')
     args = parser.parse_args()
+    if args.threads is not None:
+        if args.multiprocessing:
+            parser.error('-j and -m cannot be used together')
+        if args.threads < 1:
+            parser.error('-j must be at least 1')
+    if args.multiprocessing:
+        for option, value in (('--coalesce', args.coalesce),
+                              ('--profile', args.profile),
+                              ('--profile-json', args.profile_json),
+                              ('--outcomes', args.outcomes)):
+            if value:
+                parser.error('%s and -m cannot be used together' % option)
+    if args.shard:
+        try:
+            shard, shards = [int(i) for i in args.shard.split('/')]
+            if not 0 <= shard < shards:
+                raise ValueError
+        except ValueError:
+            parser.error('--shard must be I/N, with 0 <= I < N')
+        if not args.coordination:
+            parser.error('--shard needs --coordination')
+        args.shard = (shard, shards)
+    if args.shards is not None:
+        if args.shards < 1:
+            parser.error('--shards must be at least 1')
+        if args.shard:
+            parser.error('--shard and --shards cannot be used together')
+    if (args.shard or args.shards) and (args.multiprocessing or
+                                         args.threads):
+        parser.error('sharded imports cannot use -m or -j')
+    if args.encoding:
+        try:
+            codecs.lookup(args.encoding)
+        except LookupError:
+            parser.error('unknown encoding: %s' % args.encoding)
 
     if not args.dry_run:
-        sr = studentrecord.StudentRecord(args.studentrecord)
+        sr = studentrecord.StudentRecord(
+            args.studentrecord,
+            pool_size=max(studentrecord.StudentRecord.pool_size,
+                          args.threads or 0))
 
         try:
             # make sure we're authenticated by getting a list of our valid
@@ -111,13 +380,9 @@ used/unused fields will be printed.""")
     else:
         sr = None
 
-    data = yaml.load(args.config_file)
-    mappings = [
-            (type_,
-             [Mapping(mapping) for mapping in data[type_]])
-            for type_ in 'school', 'organization', 'person', 'course'
-            if type_ in data]
-    mappings.append(('applicant', [Mapping(data['applicant'])]))
+    mappings = config.load_mappings(
+        args.config_file,
+        cache_dir=None if args.no_cache else args.cache_dir)
     if args.quiet:
         quiet = len(args.quiet)
         level = None if quiet > 1 else 'ERROR'
@@ -129,8 +394,42 @@ used/unused fields will be printed.""")
         logging.basicConfig(stream=sys.stderr,
                             level='CRITICAL',
                             format='%(message)s')
-    importer = Importer(sr, mappings)
+    # these are counted in the parent process, so they'd miss the children's
+    # work
+    in_process = not (args.multiprocessing or args.shards)
+    if (args.profile or args.profile_json) and in_process:
+        profile = Profile()
+    else:
+        profile = None
+    if args.dry_run or not in_process:
+        outcomes = None
+    else:
+        outcomes = Outcomes(
+            sink=args.outcomes,
+            sample={'no change': args.sample_no_change})
+    importer_kwargs = dict(
+        profile=profile, outcomes=outcomes,
+        coalesce=(bool(args.coalesce or args.threads) and
+                  not args.multiprocessing),
+        chunk_size=args.chunk_size, cache_size=args.cache_size)
+    if args.shard and not args.dry_run:
+        importer = ShardedImporter(
+            sr, mappings, shard=args.shard[0], shards=args.shard[1],
+            coordinator=coordinator(args.coordination), **importer_kwargs)
+    else:
+        importer = Importer(sr, mappings, **importer_kwargs)
     importer.logger.setLevel(level)
+    sharded_rows = []
+    if args.memory:
+        monitor = MemoryMonitor(
+            interval=args.memory,
+            rss_limit=args.memory_limit and args.memory_limit * 1024 ** 2)
+        monitor.logger.setLevel('INFO' if level == 'INFO' else 'WARNING')
+        if in_process:
+            monitor.track('importer', importer.cache_sizes)
+        monitor.start()
+    else:
+        monitor = None
 
     files = args.csv_file
     if not files:
@@ -141,30 +440,21 @@ used/unused fields will be printed.""")
 
     if args.multiprocessing:
         import multiprocessing
-        pool = multiprocessing.Pool()
-    sniffer = csv.Sniffer()
+        if not args.dry_run:
+            pool = multiprocessing.Pool()
+    if args.dry_run:
+        planner = Planner(mappings)
+    if args.threads and not args.dry_run:
+        import_files(importer, files, args.threads, encoding=args.encoding,
+                     quiet=quiet)
+        files = []
     for f in files:
-        encoding = 'UTF-8'
         if f is not sys.stdin and quiet < 2:
             print ('Processing %s...' % f.name),
             sys.stdout.flush()
-        data = f.read()
-        prefix = data[:1024 ** 2]
-        if f is not sys.stdin and chardet:
-            encoding = chardet.detect(prefix)['encoding']
-        dialect = sniffer.sniff(prefix, delimiters=',\t')
-        f = StringIO(data)
+        encoding, reader = read_csv(f, args.encoding)
         if f is not sys.stdin and quiet < 2:
             print '(as %s)' % encoding
-        if encoding != 'UTF-8':
-            f = codecs.iterencode(
-                codecs.iterdecode(f, encoding), 'utf-8')
-        if args.dry_run:
-            # just the headers
-            data = [f.next()]
-        else:
-            data = list(f)
-        reader = csv.DictReader(data, dialect=dialect)
         if args.dry_run:
             d = GetSupportingDefaultDict()
             importer(d)
@@ -180,13 +470,72 @@ used/unused fields will be printed.""")
                 print 'Unused keys (%i):' % len(remaining)
                 for k in sorted(remaining):
                     print '*', k
+            planner(reader)
         else:
             if args.multiprocessing:
                 importer.logger = None
                 pool.map_async(build_row, izip(repeat(importer), repeat(level),
                                                reader))
+            elif args.shards:
+                sharded_rows.extend(reader)
             else:
                 importer(reader)
-    if args.multiprocessing:
+    if args.dry_run:
+        if planner.rows:
+            if args.concurrency:
+                concurrency = args.concurrency
+            elif args.multiprocessing:
+                concurrency = multiprocessing.cpu_count()
+            elif args.threads:
+                concurrency = args.threads
+            else:
+                concurrency = 1
+            print
+            planner.report(latency=args.latency / 1000.0,
+                           concurrency=concurrency)
+    elif args.multiprocessing:
         pool.close()
         pool.join()
+    elif args.shards:
+        import multiprocessing
+        if args.coordination:
+            address = args.coordination
+        else:
+            directory = tempfile.mkdtemp()
+            address = os.path.join(directory, 'coordination.db')
+        processes = []
+        for shard in range(args.shards):
+            sharded = ShardedImporter(
+                sr, mappings, shard=shard, shards=args.shards,
+                coordinator=coordinator(address), **importer_kwargs)
+            sharded.logger = None
+            processes.append(multiprocessing.Process(
+                target=import_shard,
+                args=(pickle.dumps(sharded, pickle.HIGHEST_PROTOCOL), level,
+                      sharded_rows)))
+        for process in processes:
+            process.start()
+        failed, stopped = wait_for_shards(processes)
+        if not args.coordination:
+            shutil.rmtree(directory)
+        if failed:
+            print 'ERROR: shards %s failed' % ', '.join(map(str, failed))
+            if stopped:
+                print 'Stopped shards %s' % ', '.join(map(str, stopped))
+            sys.exit(1)
+    elif importer.coalesce and not args.threads:
+        importer.flush()
+    if outcomes is not None:
+        outcomes.close()
+        if not quiet:
+            print
+            outcomes.report()
+    if monitor is not None:
+        monitor.stop()
+        if not quiet:
+            print
+            monitor.report()
+    if profile is not None:
+        profile.report()
+        if args.profile_json:
+            profile.dump(args.profile_json)
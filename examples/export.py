@@ -0,0 +1,120 @@
+"""
+This example exports whole endpoints from StudentRecord.com, for loading
+into analytics tools:
+
+    python export.py -s USERNAME:PASSWORD -c CUSTOMER applicant applicants.ndjson
+    python export.py -s USERNAME:PASSWORD -f location__state=MA \\
+        --format parquet school schools
+
+If an export is interrupted, run the same command again to carry on where
+it stopped.
+"""
+import argparse
+import logging
+import sys
+import studentrecord
+from studentrecord.export import Export, FORMATS
+from studentrecord.memory import MemoryMonitor
+
+
+def validate_filter(value):
+    if '=' not in value:
+        raise argparse.ArgumentTypeError('filters look like field=value')
+    return tuple(value.split('=', 1))
+
+
+def print_progress(exported, seconds):
+    sys.stderr.write('%i objects (%.1f/s)\n' % (
+        exported, exported / seconds if seconds else 0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Export an endpoint from StudentRecord.com.')
+    parser.add_argument(
+        '-s', '--studentrecord', metavar='USERNAME:PASSWORD', required=True,
+        type=lambda v: tuple(v.split(':', 1)) if ':' in v else v,
+        help='Username/password (or auth token) for SRDC (required)')
+    parser.add_argument(
+        '-c', '--customer', metavar='CUSTOMER',
+        help='Customer ID to export from (required if you can see more '
+        'than one)')
+    parser.add_argument(
+        '-f', '--filter', action='append', type=validate_filter, default=[],
+        metavar='FIELD=VALUE',
+        help='Only export objects matching the filter (may be repeated)')
+    parser.add_argument(
+        '--fields', type=lambda v: v.split(','), metavar='FIELD,...',
+        help='Only export these fields')
+    parser.add_argument(
+        '--format', choices=FORMATS, default=None,
+        help='Output format (default: parquet if OUTPUT ends in .parquet, '
+        'otherwise ndjson)')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=4, metavar='N',
+        help='Fetch N pages at once (default %(default)s)')
+    parser.add_argument(
+        '--page-size', type=int, default=500, metavar='N',
+        help='Objects per page (default %(default)s)')
+    parser.add_argument(
+        '--memory', type=float, nargs='?', const=60, metavar='SECONDS',
+        help='Log the memory use (and where it grew) every SECONDS seconds '
+        '(default 60)')
+    parser.add_argument(
+        '--memory-limit', type=float, metavar='MB',
+        help='With --memory, log a warning whenever the memory use is over '
+        'MB megabytes')
+    parser.add_argument(
+        '-q', '--quiet', action='store_true',
+        help="Don't display progress")
+    parser.add_argument('endpoint', help='Endpoint to export, e.g. applicant')
+    parser.add_argument('output', help='File (or directory, for parquet) '
+                        'to write')
+    args = parser.parse_args()
+
+    sr = studentrecord.StudentRecord(
+        args.studentrecord,
+        pool_size=max(studentrecord.StudentRecord.pool_size, args.workers))
+    try:
+        customers = list(sr['customer'])
+    except studentrecord.LoginException as e:
+        print 'ERROR: %s' % str(e)
+        sys.exit(2)
+    if args.customer:
+        sr.choose_customer(args.customer)
+    elif len(customers) == 1:
+        sr.choose_customer(customers[0])
+    else:
+        print 'ERROR: must specify a Customer (-c).  Options:'
+        for c in customers:
+            print '%s: %s' % (c['name'], c['id'])
+        sys.exit(1)
+
+    format = args.format
+    if format is None:
+        format = 'parquet' if args.output.endswith('.parquet') else 'ndjson'
+    export = Export(sr[args.endpoint].filter(**dict(args.filter)),
+                    args.output, format=format, fields=args.fields,
+                    workers=args.workers, page_size=args.page_size,
+                    progress=None if args.quiet else print_progress)
+    if args.memory:
+        logging.basicConfig(stream=sys.stderr, format='%(message)s')
+        monitor = MemoryMonitor(
+            interval=args.memory,
+            rss_limit=args.memory_limit and args.memory_limit * 1024 ** 2)
+        monitor.logger.setLevel('WARNING' if args.quiet else 'INFO')
+        monitor.start()
+    else:
+        monitor = None
+    try:
+        exported = export.run()
+    except studentrecord.StudentRecordException as e:
+        print 'ERROR: %s' % str(e)
+        sys.exit(1)
+    finally:
+        if monitor is not None:
+            monitor.stop()
+    if monitor is not None and not args.quiet:
+        monitor.report(sys.stderr)
+    if not args.quiet:
+        print 'Exported %i objects to %s' % (exported, args.output)
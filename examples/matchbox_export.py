@@ -1,10 +1,13 @@
 from optparse import OptionParser, OptionGroup
+import logging
 import sys
 import multiprocessing
 import studentrecord
 import requests
 import json
+from collections import Mapping
 from itertools import repeat, izip
+from studentrecord.memory import MemoryMonitor
 
 MBX_BASE_URL = 'https://app.admitpad.com/api/v3/%s'
 
@@ -31,6 +34,9 @@ def dict_diff(start, end):
     """
     if not start and not end:
         return False
+    if isinstance(start, Mapping) and isinstance(end, Mapping):
+        return any(dict_diff(start[k], end.get(k))
+                   for k in start)
     if type(start) != type(end):
         return True
     if isinstance(start, list):
@@ -38,9 +44,6 @@ def dict_diff(start, end):
             return True
         return any(dict_diff(start[i], end[i])
                    for i in range(len(start)))
-    if isinstance(start, dict):
-        return any(dict_diff(start[k], end.get(k))
-                   for k in start)
     return start != end
 
 
@@ -100,6 +103,19 @@ def push_applicant((program, auth, key_path, sr, applicant)):
     return key, rv
 
 
+def start_memory_monitor(interval, rss_limit, worker=False):
+    """
+    Starts logging the memory use of this process.  The pool runs this in
+    each worker, where the `srdc_data` cache lives.
+    """
+    monitor = MemoryMonitor(interval=interval, rss_limit=rss_limit)
+    monitor.logger.setLevel('INFO')
+    if worker:
+        monitor.track('srdc_data', lambda: len(srdc_data.__self__))
+    monitor.start()
+    return monitor
+
+
 if __name__ == '__main__':
     def validate_srdc_auth(option, opt, value, parser):
         if ':' in value:
@@ -136,8 +152,18 @@ if __name__ == '__main__':
         '-p', '--program', dest='matchbox_program',
         help='Program to push to on Matchbox (required)',
         metavar='PROGRAM')
+    memory_group = OptionGroup(parser, 'Memory options')
+    memory_group.add_option(
+        '--memory', dest='memory', type=float, metavar='SECONDS',
+        help='Log the memory use of each process (and where it grew) every '
+        'SECONDS seconds')
+    memory_group.add_option(
+        '--memory-limit', dest='memory_limit', type=float, metavar='MB',
+        help='With --memory, log a warning whenever a process uses more than '
+        'MB megabytes')
     parser.add_option_group(srdc_group)
     parser.add_option_group(mbx_group)
+    parser.add_option_group(memory_group)
 
     options, args = parser.parse_args()
     if (not options.studentrecord or not options.matchbox or
@@ -161,7 +187,16 @@ if __name__ == '__main__':
             parser.print_help()
             sys.exit(1)
 
-    pool = multiprocessing.Pool()
+    if options.memory:
+        logging.basicConfig(stream=sys.stderr, format='%(message)s')
+        rss_limit = options.memory_limit and options.memory_limit * 1024 ** 2
+        monitor = start_memory_monitor(options.memory, rss_limit)
+        pool = multiprocessing.Pool(
+            initializer=start_memory_monitor,
+            initargs=(options.memory, rss_limit, True))
+    else:
+        monitor = None
+        pool = multiprocessing.Pool()
     iterator = izip(repeat(options.matchbox_program),
                     repeat(options.matchbox),
                     repeat(options.key),
@@ -174,3 +209,6 @@ if __name__ == '__main__':
             print key, rv
     pool.close()
     pool.join()
+    if monitor is not None:
+        monitor.stop()
+        monitor.report(sys.stderr)
@@ -1,6 +1,11 @@
-import requests
 import urlparse
 import json
+import threading
+import time
+import zlib
+from collections import Mapping
+from studentrecord.records import RecordFactory
+from studentrecord.codec import JSONCodec
 
 
 class StudentRecordException(Exception):
@@ -22,9 +27,10 @@ class NotFound(StudentRecordException):
 
 
 class EndpointIterator(object):
-    def __init__(self, api, endpoint, **kwargs):
+    def __init__(self, api, endpoint, _factory=None, **kwargs):
         self.api = api
         self.endpoint = endpoint
+        self.factory = _factory
         self.args = kwargs
         self.args['_skip'] = 0
         self.current = None
@@ -35,29 +41,39 @@ class EndpointIterator(object):
 
     def next(self):
         if self.current is None:
-            self.current = self.api.get(self.endpoint, **self.args)
+            self.current = self._get()
             self.index = 0
         if self.index == len(self.current['data']):
             if not self.current['has_more']:
                 raise StopIteration
             self.args['_skip'] += len(self.current['data'])
-            self.current = self.api.get(self.endpoint, **self.args)
+            self.current = self._get()
             self.index = 0
         index = self.index
         self.index += 1
         return self.current['data'][index]
 
+    def _get(self):
+        page = self.api.get(self.endpoint, **self.args)
+        if self.factory is not None:
+            page['data'] = self.factory(page['data'])
+        return page
+
 
 class Endpoint(object):
     """
     Endpoint objects represent a connection to a type of API at
     StudentRecord.com.  From here, we can make queries of the data and
     create/update/delete objects.
+
+    If `factory` is given (see `compact()`), objects read from the endpoint
+    are passed through it before they're returned.
     """
-    def __init__(self, api, endpoint, filters=None):
+    def __init__(self, api, endpoint, filters=None, factory=None):
         self.api = api
         self.endpoint = endpoint
         self.filters = filters or {}
+        self.factory = factory
 
     def __iter__(self):
         """
@@ -73,6 +89,7 @@ class Endpoint(object):
         ...     item 'in Boston', item
         """
         return EndpointIterator(self.api, self.endpoint,
+                                _factory=self.factory,
                                 **self.filters)
 
     def exists(self, **filters):
@@ -84,15 +101,61 @@ class Endpoint(object):
         return bool(self.api.get(self.endpoint, _limit=1,
                                  _fields='id', **filters)['data'])
 
+    def count(self):
+        """
+        Returns the number of objects matching our filters.  The API doesn't
+        return totals, so this pages through the matching IDs.
+        """
+        args = dict(self.filters, _fields='id', _limit=1000)
+        return sum(1 for _ in EndpointIterator(self.api, self.endpoint,
+                                               **args))
+
+    def to_arrays(self, fields=None, size=None, page_size=1000):
+        """
+        Returns the matching objects as an ordered dictionary of NumPy
+        arrays, one per field, without building a dictionary per object.
+        Needs numpy; see `studentrecord.frames.to_arrays`.
+
+        >>> arrays = sr['school'].to_arrays(fields=['id', 'name', 'ceeb'])
+        """
+        from studentrecord import frames
+        return frames.to_arrays(self, fields, size, page_size)
+
+    def to_frame(self, fields=None, size=None, page_size=1000):
+        """
+        Returns the matching objects as a pandas DataFrame.  Needs pandas;
+        see `studentrecord.frames.to_frame`.
+        """
+        from studentrecord import frames
+        return frames.to_frame(self, fields, size, page_size)
+
     def filter(self, **kwargs):
         """
         Returns an Endpoint with the additional filters specified as keyword
         arguments.  Pass in no kwargs to reset the filters.
         """
         if not kwargs:
-            return Endpoint(self.api, self.endpoint)
+            return Endpoint(self.api, self.endpoint, factory=self.factory)
         return Endpoint(self.api, self.endpoint, dict(self.filters,
-                                                      **kwargs))
+                                                      **kwargs),
+                        factory=self.factory)
+
+    def compact(self, factory=None):
+        """
+        Returns an Endpoint which returns read-only
+        `studentrecord.records.Record` objects instead of dictionaries.
+        These use several times less memory than dictionaries, which matters
+        when holding the results of a full scan.
+
+        >>> applicants = list(sr['applicant'].compact())
+        """
+        return Endpoint(self.api, self.endpoint, self.filters,
+                        factory=factory or RecordFactory())
+
+    def _wrap(self, data):
+        if self.factory is None:
+            return data
+        return self.factory(data)
 
     def __getitem__(self, item):
         """
@@ -106,21 +169,21 @@ class Endpoint(object):
         if isinstance(item, slice):
             skip = item.start or 0
             limit = item.stop - skip if item.stop else 1000
-            return self.api.get(self.endpoint,
-                                _skip=skip,
-                                _limit=limit,
-                                **self.filters)['data']
+            return self._wrap(self.api.get(self.endpoint,
+                                           _skip=skip,
+                                           _limit=limit,
+                                           **self.filters)['data'])
         elif isinstance(item, int):
             data = self.api.get(self.endpoint,
                                 _skip=item,
                                 _limit=1,
                                 **self.filters)
             if data['data']:
-                return data['data'][0]
+                return self._wrap(data['data'][0])
             else:
                 raise IndexError
         else:
-            return self.api.get(self.endpoint, item)
+            return self._wrap(self.api.get(self.endpoint, item))
 
     def __setitem__(self, item, data):
         """
@@ -165,7 +228,7 @@ class Endpoint(object):
         """
         if _data is None:
             data = kwargs
-        elif isinstance(_data, dict):
+        elif isinstance(_data, Mapping):
             data = dict(_data, **kwargs)
         else:
             data = kwargs
@@ -180,13 +243,64 @@ class Endpoint(object):
         Removes a given object as this endpoint.  Takes either a populated
         object or an ID.
         """
-        if isinstance(_id, dict):
+        if isinstance(_id, Mapping):
             # passed in an actual item
             _id = _id['id']
         return self.api.delete(self.endpoint, _id)
 
 
-class StudentRecord(object):
+class BaseClient(object):
+    """
+    The request shortcuts shared by `StudentRecord` and `CustomerView`.
+    Subclasses implement `dispatch()`.
+    """
+    __slots__ = ()
+
+    def dispatch(self, method, endpoint, _id=None, **kwargs):
+        raise NotImplementedError
+
+    def get(self, endpoint, _id=None, **kwargs):
+        """
+        Shortcut to make a GET request.
+        """
+        return self.dispatch('get', endpoint, _id, **kwargs)
+
+    def put(self, endpoint, _id, **kwargs):
+        """
+        Shortcut to make a PUT request.
+        """
+        return self.dispatch('put', endpoint, _id, **kwargs)
+
+    def post(self, endpoint, **kwargs):
+        """
+        Shortcut to make a POST request.
+        """
+        return self.dispatch('post', endpoint, **kwargs)
+
+    def delete(self, endpoint, _id, **kwargs):
+        """
+        Shortcut to make a DELETE request.
+        """
+        return self.dispatch('delete', endpoint, _id, **kwargs)
+
+    # data endpoints
+    def __getitem__(self, attr):
+        """
+        If we're accessed as a dictionary, make an API Endpoint to access
+        that data.
+
+        >>> sr = StudentRecord(auth=auth)
+        >>> sr['person']
+        <Endpoint>
+        >>> sr['organization']
+        <Endpoint>
+        >>> sr['applicant']
+        <Endpoint>
+        """
+        return Endpoint(self, attr)
+
+
+class StudentRecord(BaseClient):
     """
     StudentRecord represents the base of the StudentRecord.com API.  Using
     this object, you have easy access to all of the StudentRecord.com
@@ -202,10 +316,31 @@ class StudentRecord(object):
     >>> sr.organization.delete(org)
     >>> sr.organization[org['id']]  # raises NotFound
     >>> org = sr.organization.create(name='New Organization')
+
+    A single StudentRecord object can be shared between threads which work
+    with different customers by using `for_customer()` instead of
+    `choose_customer()`.
+
+    Request bodies are encoded (and responses decoded) by `codec`; see
+    `studentrecord.codec`.  Set `compress_requests` to gzip request bodies
+    of at least `compress_min_size` bytes; responses are always requested
+    compressed.
+
+    Requests can be instrumented by passing `metrics` (a
+    `studentrecord.metrics.Metrics` object), `tracer` (an OpenTelemetry-style
+    tracer; each request runs inside `tracer.start_as_current_span()`) or
+    with `add_hook()`.
     """
     scheme = 'https'
     host = 'api.studentrecord.com'
     version = 'v1'
+    # maximum number of connections kept open to the API
+    pool_size = 10
+    metrics = None
+    tracer = None
+    codec = JSONCodec()
+    compress_requests = False
+    compress_min_size = 1024
 
     def __init__(self, auth=None, **kwargs):
         if not isinstance(auth, (list, tuple, basestring)):
@@ -219,19 +354,79 @@ class StudentRecord(object):
             self._auth_token = None
 
         self._customer = None
+        self._lock = threading.Lock()
+        self._session = None
+        self.hooks = {'pre_request': [], 'post_request': []}
 
         for k, v in kwargs.iteritems():
             setattr(self, k, v)
 
+    def __getstate__(self):
+        # locks and sessions can't be sent to other processes
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_session'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
     def choose_customer(self, customer):
         """
         Set the current customer for the API.  Only the 'login' and 'customer'
         endpoints do not require this.
         """
-        if isinstance(customer, dict):
-            self._customer = customer['id']
-        else:
-            self._customer = customer
+        self._customer = customer_id(customer)
+
+    @property
+    def customer_id(self):
+        """
+        The ID of the current customer.
+        """
+        return self._customer
+
+    def for_customer(self, customer):
+        """
+        Returns a `CustomerView` of this object for the given customer.  The
+        view shares our connections and authentication token, and doesn't
+        change when `choose_customer()` is called.
+
+        >>> for customer in sr['customer']:
+        ...     pool.apply_async(report, (sr.for_customer(customer),))
+        """
+        return CustomerView(self, customer_id(customer))
+
+    def add_hook(self, event, hook):
+        """
+        Registers a function to be called around every request.  `event` is
+        either 'pre_request' or 'post_request'; the hook is called with a
+        dictionary describing the request (method, endpoint, customer, url,
+        params, data and headers).  'pre_request' hooks can change the
+        headers.  For 'post_request' hooks, the dictionary also has status,
+        seconds, bytes_sent, bytes_received (as sent over the network),
+        uncompressed_bytes_sent, uncompressed_bytes_received and error.
+        """
+        self.hooks[event].append(hook)
+
+    @property
+    def session(self):
+        """
+        The `requests.Session` used for all of our requests.  Sessions keep
+        connections to the API open between requests.
+        """
+        if self._session is None:
+            # requests is slow to import, so wait until we need it
+            import requests
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_connections=self.pool_size,
+                        pool_maxsize=self.pool_size)
+                    session.mount('%s://' % self.scheme, adapter)
+                    self._session = session
+        return self._session
 
     @property
     def auth_token(self):
@@ -240,16 +435,21 @@ class StudentRecord(object):
         us in to get it.
         """
         if self._auth_token is None:
-            response = requests.post(self.url('login'), data=dict(
-                email=self.auth[0],
-                password=self.auth[1]))
-            if response.status_code != 200:
-                raise LoginException('invalid username/password',
-                                     response.content)
-            self._auth_token = json.loads(
-                response.content)['authentication_token']
+            with self._lock:
+                if self._auth_token is None:
+                    self._auth_token = self._login()
         return self._auth_token
 
+    def _login(self):
+        import requests
+        response = requests.post(self.url('login'), data=dict(
+            email=self.auth[0],
+            password=self.auth[1]))
+        if response.status_code != 200:
+            raise LoginException('invalid username/password',
+                                 response.content)
+        return json.loads(response.content)['authentication_token']
+
     @property
     def headers(self):
         return {'Authentication-Token': self.auth_token}
@@ -259,11 +459,14 @@ class StudentRecord(object):
         Builds a URL for the given endpoint.  If `_id` is given, it's used as
         the object ID to pass to the endpoint.
         """
+        return self._url(self._customer, endpoint, _id)
+
+    def _url(self, customer, endpoint, _id=None):
         if endpoint not in ('login', 'customer'):
-            if not self._customer:
+            if not customer:
                 raise StudentRecordException(
                     '%r endpoint requires a customer' % endpoint)
-            endpoint = '%s/%s' % (self._customer, endpoint)
+            endpoint = '%s/%s' % (customer, endpoint)
         if _id is not None:
             endpoint = '%s/%s' % (endpoint, _id)
         return urlparse.urlunparse((self.scheme, self.host, '/api/%s/%s/' % (
@@ -280,62 +483,138 @@ class StudentRecord(object):
         Any additional keyword arguments are passed in a URL arguments (GET
         requests) or as JSON data (POST/PUT requests).
         """
+        return self._dispatch(self._customer, method, endpoint, _id, **kwargs)
+
+    def _dispatch(self, customer, method, endpoint, _id=None, **kwargs):
         if method == 'get':
             params = kwargs
             data = None
         else:
             params = None
-            data = json.dumps(kwargs)
-        resp = requests.request(method, self.url(endpoint, _id), params=params,
-                                data=data,
-                                headers=self.headers)
+            data = self.codec.dumps(kwargs)
+        url = self._url(customer, endpoint, _id)
+        if self.tracer is None:
+            resp = self._request(customer, method, endpoint, url, params,
+                                 data)
+        else:
+            with self.tracer.start_as_current_span(
+                    'studentrecord %s %s' % (method.upper(), endpoint),
+                    attributes={'http.method': method.upper(),
+                                'http.url': url,
+                                'studentrecord.customer': customer or ''}
+            ) as span:
+                resp = self._request(customer, method, endpoint, url, params,
+                                     data)
+                span.set_attribute('http.status_code', resp.status_code)
         if resp.status_code == 401:
             # Unauthorized
             raise LoginException('invalid authorization')
         elif resp.status_code == 404:
-            raise NotFound(self.url(endpoint, _id))
+            raise NotFound(url)
         if resp.status_code != 200:
             raise StudentRecordException(
                 '%i from %s' % (resp.status_code, resp.url),
                 resp.content)
-        return json.loads(resp.content)
+        return self.codec.loads(resp.content)
+
+    def _request(self, customer, method, endpoint, url, params, data):
+        headers = self.headers
+        headers['Accept-Encoding'] = 'gzip, deflate'
+        body = data
+        if (data and self.compress_requests and
+                len(data) >= self.compress_min_size):
+            body = gzip(data)
+            headers['Content-Encoding'] = 'gzip'
+        info = dict(method=method, endpoint=endpoint, customer=customer,
+                    url=url, params=params, data=data,
+                    headers=headers)
+        for hook in self.hooks['pre_request']:
+            hook(info)
+        start = time.time()
+        resp = None
+        try:
+            resp = self.session.request(method, url, params=params,
+                                        data=body,
+                                        headers=info['headers'])
+            return resp
+        except Exception as e:
+            info['error'] = e
+            raise
+        finally:
+            info['seconds'] = time.time() - start
+            info['status'] = 'error' if resp is None else resp.status_code
+            info['bytes_sent'] = len(body) if body else 0
+            info['uncompressed_bytes_sent'] = len(data) if data else 0
+            if resp is None:
+                info['bytes_received'] = 0
+                info['uncompressed_bytes_received'] = 0
+            else:
+                received = len(resp.content)
+                info['uncompressed_bytes_received'] = received
+                if resp.headers.get('Content-Encoding'):
+                    received = int(resp.headers.get('Content-Length',
+                                                    received))
+                info['bytes_received'] = received
+            info.setdefault('error', None)
+            if self.metrics is not None:
+                self.metrics.record_request(
+                    method, endpoint, info['status'], info['seconds'],
+                    info['bytes_sent'], info['bytes_received'],
+                    info['uncompressed_bytes_sent'],
+                    info['uncompressed_bytes_received'])
+            for hook in self.hooks['post_request']:
+                hook(info)
+
+
+class CustomerView(BaseClient):
+    """
+    An immutable view of a `StudentRecord` object, fixed to a single
+    customer.  Views are cheap to create and safe to use from several
+    threads at once; requests go through the `StudentRecord` object they
+    were created from.
 
-    def get(self, endpoint, _id=None, **kwargs):
-        """
-        Shortcut to make a GET request.
-        """
-        return self.dispatch('get', endpoint, _id, **kwargs)
+    >>> view = sr.for_customer(customer_id)
+    >>> view['applicant'].exists(key__ssn='123-45-6789')
+    """
+    __slots__ = ('client', 'customer_id')
 
-    def put(self, endpoint, _id, **kwargs):
-        """
-        Shortcut to make a PUT request.
-        """
-        return self.dispatch('put', endpoint, _id, **kwargs)
+    def __init__(self, client, customer):
+        object.__setattr__(self, 'client', client)
+        object.__setattr__(self, 'customer_id', customer)
 
-    def post(self, endpoint, **kwargs):
-        """
-        Shortcut to make a POST request.
-        """
-        return self.dispatch('post', endpoint, **kwargs)
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
 
-    def delete(self, endpoint, _id, **kwargs):
-        """
-        Shortcut to make a DELETE request.
-        """
-        return self.dispatch('delete', endpoint, _id, **kwargs)
+    def __repr__(self):
+        return '<CustomerView %s>' % (self.customer_id,)
 
-    # data endpoints
-    def __getitem__(self, attr):
-        """
-        If we're accessed as a dictionary, make an API Endpoint to access
-        that data.
+    @property
+    def metrics(self):
+        return self.client.metrics
 
-        >>> sr = StudentRecord(auth=auth)
-        >>> sr['person']
-        <Endpoint>
-        >>> sr['organization']
-        <Endpoint>
-        >>> sr['applicant']
-        <Endpoint>
-        """
-        return Endpoint(self, attr)
+    def for_customer(self, customer):
+        return self.client.for_customer(customer)
+
+    def url(self, endpoint, _id=None):
+        return self.client._url(self.customer_id, endpoint, _id)
+
+    def dispatch(self, method, endpoint, _id=None, **kwargs):
+        return self.client._dispatch(self.customer_id, method, endpoint, _id,
+                                     **kwargs)
+
+
+def gzip(data):
+    """
+    Returns `data` compressed in the gzip format.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def customer_id(customer):
+    """
+    Returns the ID of a customer given either the customer object or the ID.
+    """
+    if isinstance(customer, Mapping):
+        return customer['id']
+    return customer
@@ -0,0 +1,85 @@
+"""
+JSON encoding and decoding for API requests.
+
+`StudentRecord` encodes request bodies and decodes responses with its
+`codec`.  By default that's a `JSONCodec`, which uses the fastest JSON
+library installed: ujson or simplejson if they're present, the standard
+library's json otherwise.  Any object with `dumps()` and `loads()` methods
+can be used instead:
+
+>>> sr = StudentRecord(auth, codec=JSONCodec('json'))
+"""
+import importlib
+from studentrecord.records import json_default
+
+FASTEST = ('ujson', 'simplejson', 'json')
+
+
+def _first_available(names, check=None):
+    for name in names:
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            continue
+        if check is None or check(module):
+            return module
+    raise ImportError('none of %s are available' % ', '.join(names))
+
+
+def _supports_default(module):
+    # records are encoded with a `default` hook, which older versions of
+    # ujson don't have
+    try:
+        module.dumps(object(), default=lambda o: None)
+    except Exception:
+        return False
+    return True
+
+
+class JSONCodec(object):
+    """
+    Encodes with the module named `encoder` and decodes with the one named
+    `decoder` (anything with `dumps()`/`loads()`).  If `decoder` isn't
+    given, `encoder` is used for both; if neither is, the fastest available
+    library is used for each.  Libraries are imported when the codec is
+    first used.
+    """
+
+    def __init__(self, encoder=None, decoder=None):
+        self.encoder_name = encoder
+        self.decoder_name = decoder or encoder
+        self._encoder = None
+        self._decoder = None
+
+    def __repr__(self):
+        return 'JSONCodec(%r, %r)' % (self.encoder_name, self.decoder_name)
+
+    def __getstate__(self):
+        return (self.encoder_name, self.decoder_name)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @property
+    def encoder(self):
+        if self._encoder is None:
+            if self.encoder_name:
+                names = (self.encoder_name,)
+            else:
+                names = FASTEST
+            self._encoder = _first_available(names, _supports_default)
+        return self._encoder
+
+    @property
+    def decoder(self):
+        if self._decoder is None:
+            self._decoder = _first_available((self.decoder_name,)
+                                             if self.decoder_name
+                                             else FASTEST)
+        return self._decoder
+
+    def dumps(self, o):
+        return self.encoder.dumps(o, default=json_default)
+
+    def loads(self, s):
+        return self.decoder.loads(s)
@@ -0,0 +1,89 @@
+"""
+Loads import configurations: YAML files mapping CSV rows to objects (see
+examples/csv_import.yaml).
+
+Parsing YAML is slow, so if `cache_dir` is given the parsed mappings are
+stored there, keyed by a hash of the YAML, and later loads of the same
+configuration read them back instead.  Compiled Jinja2 templates are cached
+in the same directory.
+
+>>> mappings = load_mappings(open('csv_import.yaml'),
+...                          cache_dir=DEFAULT_CACHE_DIR)
+>>> importer = Importer(sr, mappings)
+"""
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+from studentrecord import mapping
+
+# the types which can have several mappings, in the order they're imported
+TYPES = ('school', 'organization', 'person', 'course')
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'studentrecord')
+
+# change this when the cached format changes
+CACHE_VERSION = '1'
+
+
+def build_mappings(data):
+    """
+    Turns a parsed configuration into the list of (type, [Mapping]) pairs
+    that `studentrecord.importer.Importer` takes.
+    """
+    mappings = [
+        (type_,
+         [mapping.Mapping(m) for m in data[type_]])
+        for type_ in TYPES
+        if type_ in data]
+    mappings.append(('applicant', [mapping.Mapping(data['applicant'])]))
+    return mappings
+
+
+def load_mappings(fp, cache_dir=None):
+    """
+    Reads the YAML configuration from the file `fp` and returns its
+    mappings.
+    """
+    source = fp.read()
+    if not cache_dir:
+        return _parse(source)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # created by another process in the meantime
+            if not os.path.isdir(cache_dir):
+                raise
+    mapping.set_template_cache(cache_dir)
+    digest = hashlib.sha1(CACHE_VERSION + source).hexdigest()
+    filename = os.path.join(cache_dir, '%s.mappings' % digest)
+    try:
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        pass
+    mappings = _parse(source)
+    # compile the templates now, so they're in the cache too
+    templates = [t for (_, ms) in mappings for m in ms
+                 for t in m.templates()]
+    if templates and mapping._import('jinja2'):
+        for t in templates:
+            mapping.template(t)
+    _write(filename, mappings)
+    return mappings
+
+
+def _parse(source):
+    import yaml
+    return build_mappings(yaml.safe_load(source))
+
+
+def _write(filename, mappings):
+    # write to a temporary file first, so a concurrent run never reads a
+    # partial file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(mappings, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, filename)
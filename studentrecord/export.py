@@ -0,0 +1,297 @@
+"""
+Bulk export of an endpoint to a file.
+
+>>> Export(sr['applicant'], 'applicants.ndjson').run()
+>>> Export(sr['school'].filter(location__state='MA'), 'schools',
+...        format='parquet').run()
+
+Pages are fetched `workers` at a time (a "window" of pages) and written in
+order, so at most one window of objects is held in memory however big the
+endpoint is.  The formats are:
+
+* ndjson: one JSON object per line, written to the file `path`.
+* parquet: a directory `path` of Parquet files, one per window, which
+  pyarrow (and pandas, Spark, etc.) read as a single table.  Needs
+  pyarrow.  Nested fields are flattened with the same `field__subfield`
+  names as `Importer.dict_to_query`; lists are stored as JSON text, and
+  every value as text.  Every file has the same columns: when the export
+  finishes, files written before a field first appeared are rewritten
+  with it as nulls.
+
+After each window, progress is saved to a state file next to the output
+(`<path>.state`).  If an export is interrupted, running it again with the
+same arguments carries on after the last saved window, discarding anything
+written after it.  The state file is removed when the export finishes.
+Resuming relies on the endpoint returning objects in the same order, so
+it's only reliable if the endpoint isn't being changed at the same time.
+"""
+import json
+import os
+import time
+from multiprocessing.pool import ThreadPool
+from studentrecord import StudentRecordException
+from studentrecord.records import json_default
+
+FORMATS = ('ndjson', 'parquet')
+
+
+def flatten(obj, prefix='', output=None):
+    """
+    Flattens nested dictionaries into one, naming the fields as in
+    `Importer.dict_to_query`.  Lists are encoded as JSON.
+
+    >>> flatten({'name': {'first': 'A'}, 'tags': [1, 2]})
+    {'name__first': 'A', 'tags': '[1, 2]'}
+    """
+    if output is None:
+        output = {}
+    for k, v in obj.iteritems():
+        name = '%s__%s' % (prefix, k) if prefix else k
+        if hasattr(v, 'iteritems'):
+            flatten(v, name, output)
+        elif isinstance(v, (list, tuple)):
+            output[name] = json.dumps(v, default=json_default)
+        else:
+            output[name] = v
+    return output
+
+
+class NDJSONWriter(object):
+    """
+    Writes objects to the file `path`, one JSON object per line.  The
+    position is the size of the file.
+    """
+
+    def __init__(self, path, position=0):
+        self.path = path
+        if position:
+            self.file = open(path, 'r+b')
+            self.file.truncate(position)
+            self.file.seek(position)
+        else:
+            self.file = open(path, 'wb')
+
+    def write(self, objects):
+        self.file.write(''.join(json.dumps(o, default=json_default) + '\n'
+                                for o in objects))
+
+    def position(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def finish(self):
+        pass
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter(object):
+    """
+    Writes each batch of objects as a Parquet file in the directory `path`,
+    flattening them first, and gives the files the same columns in
+    `finish()`.  The position is the number of files.
+    """
+    extension = '.parquet'
+
+    def __init__(self, path, position=0):
+        # pyarrow is big and optional, so only import it if we need it
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise StudentRecordException(
+                'exporting to Parquet needs pyarrow installed')
+        self.pyarrow = pyarrow
+        self.path = path
+        self.parts = position
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # remove any parts from after the point we're resuming from
+        for part, filename in self._files():
+            if part >= position:
+                os.remove(filename)
+
+    def _files(self):
+        """
+        Returns the (number, filename) of each part in the directory, in
+        order.
+        """
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith(self.extension):
+                try:
+                    part = int(name.split('-')[1].split('.')[0])
+                except (IndexError, ValueError):
+                    continue
+                files.append((part, os.path.join(self.path, name)))
+        files.sort()
+        return files
+
+    def write(self, objects):
+        if not objects:
+            return
+        rows = [flatten(o) for o in objects]
+        columns = sorted(set().union(*rows))
+        data = dict((c, [_text(r.get(c)) for r in rows]) for c in columns)
+        table = self.pyarrow.Table.from_arrays(
+            [self.pyarrow.array(data[c], type=self.pyarrow.string())
+             for c in columns], names=columns)
+        filename = os.path.join(self.path, 'part-%05i%s' % (self.parts,
+                                                            self.extension))
+        self._write_table(table, filename)
+        self.parts += 1
+
+    def _write_table(self, table, filename):
+        self.pyarrow.parquet.write_table(table, filename + '.tmp')
+        os.rename(filename + '.tmp', filename)
+
+    def position(self):
+        return self.parts
+
+    def finish(self):
+        """
+        Rewrites the parts which don't have every column (in the same
+        order), adding the missing ones as nulls.  Only their schemas are
+        read to find out which those are.
+        """
+        pyarrow = self.pyarrow
+        schemas = [(filename, pyarrow.parquet.read_schema(filename).names)
+                   for (_, filename) in self._files()]
+        columns = sorted(set().union(*[names for (_, names) in schemas]))
+        for filename, names in schemas:
+            if names == columns:
+                continue
+            table = pyarrow.parquet.read_table(filename)
+            arrays = []
+            for c in columns:
+                if c in names:
+                    arrays.append(table.column(c))
+                else:
+                    arrays.append(pyarrow.array([None] * table.num_rows,
+                                                type=pyarrow.string()))
+            self._write_table(pyarrow.Table.from_arrays(arrays, names=columns),
+                              filename)
+
+    def close(self):
+        pass
+
+
+def _text(value):
+    if value is None or isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    if isinstance(value, bool):
+        return u'true' if value else u'false'
+    return unicode(value)
+
+
+WRITERS = {
+    'ndjson': NDJSONWriter,
+    'parquet': ParquetWriter,
+}
+
+
+class Export(object):
+    """
+    Exports the objects of `endpoint` (an `Endpoint`, possibly filtered) to
+    `path` in `format`, fetching `workers` pages of `page_size` objects at
+    once.  `fields` limits the fields which are exported.  `progress`, if
+    given, is called after each window with the number of objects exported
+    so far and the seconds taken.
+    """
+
+    def __init__(self, endpoint, path, format='ndjson', fields=None,
+                 workers=4, page_size=500, progress=None):
+        if format not in WRITERS:
+            raise ValueError('format must be one of %s' % ', '.join(FORMATS))
+        self.endpoint = endpoint
+        self.path = path
+        self.format = format
+        self.fields = fields
+        self.workers = workers
+        self.page_size = page_size
+        self.progress = progress
+        self.state_path = path + '.state'
+        self.exported = 0
+
+    def _description(self):
+        return dict(endpoint=self.endpoint.endpoint,
+                    filters=self.endpoint.filters,
+                    format=self.format,
+                    fields=self.fields)
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path) as f:
+            state = json.load(f)
+        if state['export'] != json.loads(json.dumps(self._description())):
+            raise StudentRecordException(
+                '%s is from a different export; remove it to start '
+                'again' % self.state_path)
+        return state
+
+    def _save_state(self, skip, position):
+        state = dict(export=self._description(), skip=skip,
+                     position=position)
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(self.state_path + '.tmp', self.state_path)
+
+    def _fetch(self, skip):
+        args = dict(self.endpoint.filters, _skip=skip,
+                    _limit=self.page_size)
+        if self.fields:
+            args['_fields'] = ','.join(self.fields)
+        return self.endpoint.api.get(self.endpoint.endpoint, **args)
+
+    def run(self):
+        """
+        Runs (or resumes) the export, and returns the number of objects
+        exported.
+        """
+        state = self._load_state()
+        if state is None:
+            skip = position = 0
+        else:
+            skip, position = state['skip'], state['position']
+        self.exported = skip
+        writer = WRITERS[self.format](self.path, position)
+        pool = ThreadPool(self.workers)
+        start = time.time()
+        try:
+            more = True
+            while more:
+                page_size = self.page_size
+                pages = pool.map(self._fetch,
+                                 [skip + i * page_size
+                                  for i in range(self.workers)])
+                objects = []
+                for page in pages:
+                    data = page['data']
+                    objects.extend(data)
+                    skip += len(data)
+                    more = page['has_more']
+                    if not more:
+                        break
+                    if len(data) < page_size:
+                        # the API returned smaller pages than we asked for,
+                        # so the later pages in the window don't line up;
+                        # use its size from here on
+                        self.page_size = len(data) or 1
+                        break
+                writer.write(objects)
+                self.exported = skip
+                self._save_state(skip, writer.position())
+                if self.progress is not None:
+                    self.progress(self.exported, time.time() - start)
+            writer.finish()
+        finally:
+            pool.close()
+            pool.join()
+            writer.close()
+        os.remove(self.state_path)
+        return self.exported
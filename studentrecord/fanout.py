@@ -0,0 +1,149 @@
+"""
+Runs the same query against many customers at once.
+
+A query is any function which takes a `studentrecord.CustomerView` and
+returns a value; the helpers below build the common ones.  Queries which
+return an iterator (like `scan()`) have each item streamed back as it
+arrives.
+
+>>> fan = FanOut(sr, count('applicant', location__state='MA'), workers=20)
+>>> for result in fan:
+...     print result.customer, result.value
+>>> fan.errors
+{'customer-id': StudentRecordException(...)}
+
+Results are `Result` tuples of (customer, value, error).  If a customer's
+query fails, a single result with `error` set is yielded for it, and the
+other customers carry on.
+"""
+import Queue
+import threading
+from collections import Iterator, namedtuple
+from studentrecord import customer_id
+
+Result = namedtuple('Result', 'customer value error')
+
+_DONE = object()
+
+
+def scan(endpoint, **filters):
+    """
+    Streams every object at the endpoint matching the filters.
+    """
+    def query(view):
+        return iter(view[endpoint].filter(**filters))
+    return query
+
+
+def exists(endpoint, **filters):
+    """
+    Whether any object at the endpoint matches the filters.
+    """
+    def query(view):
+        return view[endpoint].exists(**filters)
+    return query
+
+
+def count(endpoint, **filters):
+    """
+    The number of objects at the endpoint matching the filters.
+    """
+    def query(view):
+        return view[endpoint].filter(**filters).count()
+    return query
+
+
+def first(endpoint, limit=1, **filters):
+    """
+    The list of the first `limit` objects matching the filters.
+    """
+    def query(view):
+        return view[endpoint].filter(**filters)[:limit]
+    return query
+
+
+class FanOut(object):
+    """
+    Runs `query` for each of `customers` (by default, every customer `sr`
+    can see), with at most `workers` customers being queried at once.
+    Iterating the FanOut yields `Result`s in the order they arrive.  At
+    most `buffer_size` results are held waiting to be consumed.
+    """
+
+    def __init__(self, sr, query, customers=None, workers=10,
+                 buffer_size=1000):
+        self.sr = sr
+        self.query = query
+        self.customers = customers
+        self.workers = workers
+        self.buffer_size = buffer_size
+        self.errors = {}
+
+    def __iter__(self):
+        if self.customers is None:
+            customers = [c['id'] for c in self.sr['customer']]
+        else:
+            customers = [customer_id(c) for c in self.customers]
+        pending = Queue.Queue()
+        for customer in customers:
+            pending.put(customer)
+        results = Queue.Queue(self.buffer_size)
+        stopped = threading.Event()
+        threads = [threading.Thread(target=self._worker,
+                                    args=(pending, results, stopped))
+                   for _ in range(min(self.workers, len(customers)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        remaining = len(customers)
+        try:
+            while remaining:
+                result = results.get()
+                if result is _DONE:
+                    remaining -= 1
+                    continue
+                if result.error is not None:
+                    self.errors[result.customer] = result.error
+                yield result
+        finally:
+            # if we weren't consumed to the end, let the workers finish
+            # their current request and stop
+            stopped.set()
+            for thread in threads:
+                thread.join()
+
+    def _worker(self, pending, results, stopped):
+        while not stopped.is_set():
+            try:
+                customer = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                value = self.query(self.sr.for_customer(customer))
+                if isinstance(value, Iterator):
+                    for item in value:
+                        if not self._put(results, stopped,
+                                         Result(customer, item, None)):
+                            return
+                else:
+                    self._put(results, stopped, Result(customer, value, None))
+            except Exception as e:
+                self._put(results, stopped, Result(customer, None, e))
+            self._put(results, stopped, _DONE)
+
+    @staticmethod
+    def _put(results, stopped, item):
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+
+def fan_out(sr, query, customers=None, workers=10):
+    """
+    Shortcut for iterating a `FanOut`.
+    """
+    return iter(FanOut(sr, query, customers, workers))
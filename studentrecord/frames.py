@@ -0,0 +1,282 @@
+"""
+Columnar access to endpoints, with NumPy and pandas.
+
+>>> arrays = sr['applicant'].filter(gender='F').to_arrays(
+...     fields=['id', 'name', 'birth'])
+>>> arrays['birth__date']
+array(['1995-02-24T00:00:00.000000', ...], dtype='datetime64[us]')
+>>> frame = sr['applicant'].to_frame(fields=['id', 'name', 'birth'])
+
+Objects are read a page at a time and their values written straight into
+a growable array per column, rather than being collected into a list of
+dictionaries first.  Pass `size` if you know (roughly) how many objects
+there are, so the arrays start out big enough.  Nested fields are
+flattened with the same `field__subfield` names as
+`Importer.dict_to_query`, and lists are stored as JSON text.
+
+Columns are typed from their values:
+
+* numbers: int64, or float64 if any are fractional or missing (as NaN);
+  objects if a float64 would round any of them (beyond 2**53)
+* booleans: bool, or objects (with None) if any are missing
+* dates and times (ISO 8601 strings): datetime64[us], missing as NaT; the
+  strings as objects if any aren't real dates (such as 0000-00-00)
+* anything else, or a mix of types: objects, missing as None
+
+It works the other way as well: an `Importer` can be called with a
+DataFrame, whose rows are seen by the mappings as `FrameRow`s.  Read CSV
+files with `pandas.read_csv(f, dtype=str)` if codes with leading zeros
+(ZIP codes, CEEB codes) shouldn't be turned into numbers.
+"""
+import re
+from collections import Mapping, OrderedDict
+from studentrecord import EndpointIterator, StudentRecordException
+from studentrecord.export import flatten
+
+DATETIME = re.compile(r'^\d{4}-\d{2}-\d{2}'
+                      r'(T\d{2}:\d{2}(:\d{2}(\.\d{1,6})?)?)?$')
+DTYPES = {'number': 'int64', 'bool': bool, 'datetime': object,
+          'object': object}
+INT64 = 2 ** 63
+# the largest magnitude below which every whole number is a float64
+FLOAT64_EXACT = 2 ** 53
+
+
+def _numpy():
+    # numpy is big and optional, so only import it if we need it
+    try:
+        import numpy
+    except ImportError:
+        raise StudentRecordException('columnar access needs numpy installed')
+    return numpy
+
+
+def _kind(value):
+    if isinstance(value, bool):
+        return 'bool'
+    elif isinstance(value, (int, long, float)):
+        return 'number'
+    elif isinstance(value, basestring) and DATETIME.match(value):
+        return 'datetime'
+    return 'object'
+
+
+class _Column(object):
+    """
+    A growable array for one column, with a mask of the rows which have a
+    value.  Numbers are kept as int64 until one is fractional; dates and
+    times are kept as their strings, and parsed by `finish()`.
+    """
+    __slots__ = ('numpy', 'kind', 'data', 'present', 'count', 'integer',
+                 'exact')
+
+    def __init__(self, numpy, kind, capacity):
+        self.numpy = numpy
+        self.kind = kind
+        self.data = self._empty(DTYPES[kind], capacity)
+        self.present = numpy.zeros(capacity, dtype=bool)
+        # the number of rows with a value
+        self.count = 0
+        # whether every number is whole
+        self.integer = True
+        # whether every number fits in a float64 without rounding
+        self.exact = True
+
+    def _empty(self, dtype, capacity):
+        if dtype == object:
+            return self.numpy.full(capacity, None, dtype=object)
+        return self.numpy.zeros(capacity, dtype=dtype)
+
+    def grow(self, capacity):
+        size = len(self.data)
+        data = self._empty(self.data.dtype, capacity)
+        data[:size] = self.data
+        self.data = data
+        present = self.numpy.zeros(capacity, dtype=bool)
+        present[:size] = self.present
+        self.present = present
+
+    def set(self, index, value):
+        if self.kind != 'object':
+            if _kind(value) != self.kind:
+                self._objects()
+            elif self.kind == 'number':
+                self._number(value)
+        self.data[index] = value
+        self.present[index] = True
+        self.count += 1
+
+    def _number(self, value):
+        """
+        Changes the column's type if `value` doesn't fit in it.
+        """
+        if isinstance(value, float):
+            if not value.is_integer() or abs(value) >= INT64:
+                self.integer = False
+        elif not -INT64 <= value < INT64:
+            # too big for int64, and for float64 without rounding
+            self._objects()
+            return
+        elif abs(value) > FLOAT64_EXACT:
+            self.exact = False
+        if self.integer:
+            return
+        if not self.exact:
+            self._objects()
+        elif self.data.dtype != 'float64':
+            self.data = self.data.astype('float64')
+
+    def _objects(self):
+        """
+        Converts our values into objects, with None where they're missing.
+        """
+        if self.data.dtype != object:
+            objects = self._empty(object, len(self.data))
+            objects[self.present] = self.data[self.present].tolist()
+            self.data = objects
+        self.kind = 'object'
+
+    def finish(self, length):
+        numpy = self.numpy
+        data = self.data[:length]
+        missing = ~self.present[:length]
+        complete = self.count == length
+        if self.kind == 'number' and not complete:
+            if not self.exact:
+                self._objects()
+                return self.data[:length]
+            data = data.astype('float64')
+            data[missing] = numpy.nan
+        elif self.kind == 'bool' and not complete:
+            self._objects()
+            return self.data[:length]
+        elif self.kind == 'datetime':
+            try:
+                return data.astype('datetime64[us]')
+            except ValueError:
+                # date-shaped, but not a date (such as 0000-00-00)
+                return data
+        return data
+
+
+def _order(names, fields):
+    """
+    Orders columns as `fields` were given (or by name), with the ID first.
+    """
+    def key(name):
+        field = name.split('__', 1)[0]
+        if fields and field in fields:
+            position = fields.index(field)
+        else:
+            position = len(fields or ())
+        return (name != 'id', position, name)
+    return sorted(names, key=key)
+
+
+def to_arrays(endpoint, fields=None, size=None, page_size=1000):
+    """
+    Returns an ordered dictionary of NumPy arrays, one per flattened field,
+    for the objects at `endpoint`.  `fields` limits the fields which are
+    fetched.  The arrays start out with room for `size` objects (or one
+    page), and double in size when they run out.
+    """
+    numpy = _numpy()
+    args = dict(endpoint.filters, _limit=page_size)
+    if fields:
+        args['_fields'] = ','.join(fields)
+    capacity = max(size or page_size, 1)
+    columns = {}
+    length = 0
+    for obj in EndpointIterator(endpoint.api, endpoint.endpoint, **args):
+        if length == capacity:
+            capacity *= 2
+            for column in columns.itervalues():
+                column.grow(capacity)
+        for name, value in flatten(obj).iteritems():
+            if value is None:
+                continue
+            column = columns.get(name)
+            if column is None:
+                column = columns[name] = _Column(numpy, _kind(value),
+                                                 capacity)
+            column.set(length, value)
+        length += 1
+    return OrderedDict((name, columns[name].finish(length))
+                       for name in _order(columns, fields))
+
+
+def to_frame(endpoint, fields=None, size=None, page_size=1000):
+    """
+    Returns the objects at `endpoint` as a pandas DataFrame, with a column
+    per flattened field (see `to_arrays()`).
+    """
+    try:
+        import pandas
+    except ImportError:
+        raise StudentRecordException('to_frame() needs pandas installed')
+    arrays = to_arrays(endpoint, fields, size, page_size)
+    return pandas.DataFrame(arrays, columns=list(arrays))
+
+
+class FrameRow(Mapping):
+    """
+    A read-only view of one row of a DataFrame, which looks like the rows
+    `csv.DictReader` gives the `Importer`: values are unicode, and missing
+    values (NaN, None, NaT) are ''.  Keys which are set (such as the IDs of
+    created objects) are kept alongside the row rather than in the frame.
+    """
+    __slots__ = ('_index', '_values', '_extra')
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+        self._extra = None
+
+    def __getitem__(self, key):
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        return _text(self._values[self._index[key]])
+
+    def __setitem__(self, key, value):
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __iter__(self):
+        for key in self._index:
+            yield key
+        if self._extra is not None:
+            for key in self._extra:
+                if key not in self._index:
+                    yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return 'FrameRow(%r)' % dict(self.iteritems())
+
+
+def frame_rows(frame):
+    """
+    Yields a `FrameRow` for each row of the DataFrame `frame`.
+    """
+    index = dict((unicode(c), i) for (i, c) in enumerate(frame.columns))
+    for values in frame.itertuples(index=False, name=None):
+        yield FrameRow(index, values)
+
+
+def _text(value):
+    if value is None or value != value:
+        # None, NaN or NaT
+        return u''
+    elif isinstance(value, unicode):
+        return value
+    elif isinstance(value, str):
+        return value.decode('utf-8')
+    elif isinstance(value, float) and value.is_integer():
+        # integer columns with missing values are floats in pandas
+        return unicode(int(value))
+    elif hasattr(value, 'isoformat'):
+        return unicode(value.isoformat())
+    return unicode(value)
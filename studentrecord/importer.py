@@ -1,4 +1,12 @@
 import logging
+import sys
+import threading
+from collections import Mapping, OrderedDict
+
+# number of locks shared between the objects seen while coalescing
+OBJECT_LOCKS = 64
+# number of objects remembered while coalescing
+CACHE_SIZE = 10000
 
 
 class Importer(object):
@@ -7,49 +15,201 @@ class Importer(object):
     endpoints to lists of `studentrecord.mapping.Mapping` objects.  You can
     then call the resulting object with dictionaries to map the given data
     into your `StudentRecord` object.
+
+    Pass a `studentrecord.profiling.Profile` as `profile` to record where
+    the time goes, and a `studentrecord.outcomes.Outcomes` as `outcomes` to
+    count (and optionally stream) what happened to each object.
+
+    With `coalesce=True`, each object is looked up once and remembered for
+    later rows.  The `cache_size` most recently used objects are kept;
+    others are looked up again if they appear again.  Updates to objects
+    which appear in many rows (a parent or an employer, for
+    example) are merged and written once, when `chunk_size` objects have
+    pending changes or when `flush()` is called.  Calling the importer with
+    several rows flushes at the end; call `flush()` yourself after passing
+    rows one at a time.  New objects are still created immediately, so that
+    their IDs can be used by `type[_key]` references.
+
+    A coalescing importer can be shared between threads: each object is
+    looked up and created by one thread at a time, so rows in different
+    threads which refer to the same object share it rather than creating
+    it twice.
     """
     log_name = 'studentrecord.importer.Importer'
 
-    def __init__(self, sr, mappings):
+    def __init__(self, sr, mappings, profile=None, coalesce=False,
+                 chunk_size=1000, outcomes=None, cache_size=CACHE_SIZE):
         self.logger = logging.getLogger(self.log_name)
         self.sr = sr
         self.mappings = mappings
+        self.profile = profile
+        if profile is not None:
+            profile.attach(sr)
+        self.outcomes = outcomes
+        self.coalesce = coalesce
+        self.chunk_size = chunk_size
+        self.cache_size = cache_size
+        # (type, query) -> _Pending for the objects seen while coalescing,
+        # least recently used first
+        self._objects = OrderedDict()
+        # the _Pending objects which have changes to write
+        self._dirty = OrderedDict()
+        self._create_locks()
+
+    def _create_locks(self):
+        # _lock guards _objects and _dirty; each object is held under one of
+        # _object_locks while it's looked up, created, merged or written
+        self._lock = threading.Lock()
+        self._object_locks = [threading.Lock() for _ in range(OBJECT_LOCKS)]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        del state['_object_locks']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._create_locks()
+
+    def _object_lock(self, key):
+        return self._object_locks[hash(key) % len(self._object_locks)]
+
+    def _cached(self, key):
+        with self._lock:
+            pending = self._objects.pop(key, None)
+            if pending is not None:
+                # it's now the most recently used
+                self._objects[key] = pending
+            return pending
+
+    def _remember(self, key, pending):
+        """
+        Adds an object to the ones seen while coalescing, and forgets the
+        least recently used ones beyond `cache_size`.  Called with the
+        object's lock held.
+        """
+        with self._lock:
+            self._objects[key] = pending
+            excess = len(self._objects) - self.cache_size
+            if excess <= 0:
+                return
+            # objects with changes which haven't been written, or which
+            # another thread is using, are kept for now
+            forget = []
+            for k, p in self._objects.iteritems():
+                if len(forget) == excess:
+                    break
+                lock = self._object_lock(k)
+                if not lock.acquire(False):
+                    continue
+                try:
+                    if not p.merged:
+                        forget.append(k)
+                finally:
+                    lock.release()
+            for k in forget:
+                del self._objects[k]
 
     def __call__(self, *rows):
         """
         Build a dictionary for the given row(s).  If passed a single row, just
         return that row.  If passed a list/tuple, or multiple rows as
-        arguments, yield each one in turn.
+        arguments, yield each one in turn.  A pandas DataFrame is imported
+        row by row, as `studentrecord.frames.FrameRow`s.
         """
-        if len(rows) == 1 and hasattr(rows[0], 'items'):
+        if len(rows) == 1 and hasattr(rows[0], 'itertuples'):
+            from studentrecord.frames import frame_rows
+            rows = frame_rows(rows[0])
+        elif len(rows) == 1 and hasattr(rows[0], 'items'):
             self._build_row(rows[0])
+            return
         elif len(rows) == 1:
             rows = rows[0]
         for row in rows:
             self._build_row(row)
+        if self.coalesce:
+            self.flush()
+
+    def cache_sizes(self):
+        """
+        The number of objects held while coalescing, and how many of them
+        have changes waiting to be written (see
+        `studentrecord.memory.MemoryMonitor.track`).
+        """
+        return dict(objects=len(self._objects), pending=len(self._dirty))
+
+    def _stage(self, type_, index, stage):
+        if self.profile is None:
+            return _no_stage
+        return self.profile.stage(type_, index, stage)
 
     def _build_row(self, row):
         for type_, mappings in self.mappings:
-            for mapping in mappings:
+            for index, mapping in enumerate(mappings):
                 try:
-                    obj = mapping(row)
+                    with self._stage(type_, index, 'render'):
+                        obj = mapping(row)
                 except:
-                    self.logger.error('while rendering %r on row:\n%s',
-                                      mapping, row,
-                                      exc_info=True,
-                                      extra=dict(
-                                          action='error',
-                                          mapping=mapping,
-                                          type=type_))
+                    self._outcome('error', type_, None, None,
+                                  mapping=mapping, row=row)
                     return
                 if not obj:
-                    # missing a required field
+                    if obj is None:
+                        # missing a required field
+                        self._dropped(type_, index, row)
                     continue
-                updated = self.upsert(type_, obj)
+                updated = self.upsert(type_, obj, index)
                 if updated and '_key' in obj:
                     key = '%s[%s]' % (type_, obj['_key'])
                     row[key] = updated['id']
 
+    def _dropped(self, type_, index, row):
+        """
+        Called when mapping `index` of `type_` didn't build an object for
+        the row because its `_required` fields were missing.
+        """
+
+    def _outcome(self, action, type_, query, obj, update=None, mapping=None,
+                 row=None):
+        """
+        Records what happened to an object with `outcomes` and the logger.
+        Errors should be recorded from the `except` block; errors while
+        rendering the object pass the `mapping` and `row` instead.
+        """
+        error = None
+        if action == 'error':
+            error = _exception()
+        if self.outcomes is not None:
+            self.outcomes.record(type_, action, query, obj, update, error)
+        if action == 'error' and mapping is not None:
+            self.logger.error('while rendering %r on row:\n%s',
+                              mapping, row,
+                              exc_info=True,
+                              extra=dict(
+                                  action=action,
+                                  mapping=mapping,
+                                  type=type_))
+        elif action == 'error':
+            self.logger.error(
+                'error %s %s\nobject: %s', type_.upper(), query, obj,
+                exc_info=True,
+                extra=dict(
+                    action=action,
+                    type=type_,
+                    query=query,
+                    object=obj))
+        elif self.logger.isEnabledFor(logging.INFO):
+            extra = dict(
+                action=action,
+                type=type_,
+                query=query,
+                object=obj)
+            if update is not None:
+                extra['update'] = update
+            self.logger.info('%s %s %s', action, type_.upper(), query,
+                             extra=extra)
+
     def dict_to_query(self, d):
         """
         Given a dictionary, remaps it into ORM-style queries.  For example:
@@ -90,9 +250,10 @@ class Importer(object):
         """
         This function looks through an old and new dictionary, and returns a
         dictionary containing the updated values.  Recurses into child
-        dictionaries, but not child lists.
+        dictionaries, but not child lists.  `old` can be any mapping (such as
+        a `studentrecord.records.Record`).
         """
-        if not isinstance(new, dict):
+        if not isinstance(new, Mapping):
             if old == new:
                 return None
             else:
@@ -103,7 +264,7 @@ class Importer(object):
                 continue
             if k[0] == '_':
                 continue
-            if isinstance(v, dict):
+            if isinstance(v, Mapping):
                 v2 = self.get_update(v, new[k])
                 if not v2:
                     continue
@@ -141,11 +302,12 @@ class Importer(object):
             output[k] = v
         return output
 
-    def upsert(self, type_, obj):
+    def upsert(self, type_, obj, index=None):
         """
         With an object of the given type, either create it or update it at the
         appropriate endpoint.  We check our data against what was returned to
-        prevent (some) spurious updates.
+        prevent (some) spurious updates.  `index` is the index of the mapping
+        which built the object, for profiling.
         """
         if not self.sr:
             # dry run, just no-op
@@ -153,49 +315,157 @@ class Importer(object):
         query = self.query_for_obj(obj)
         if not query:
             return
+        if self.coalesce:
+            return self._upsert_pending(type_, query, obj, index)
         endpoint = self.sr[type_]
         try:
-            existing = endpoint.filter(**query)[:1]
+            with self._stage(type_, index, 'lookup'):
+                existing = endpoint.filter(**query)[:1]
             if existing:
-                u = self.get_update(existing[0], obj)
+                with self._stage(type_, index, 'diff'):
+                    u = self.get_update(existing[0], obj)
                 if u:
-                    endpoint[existing[0]] = obj
-                    self.logger.info(
-                        'updated %s %s', type_.upper(), query,
-                        extra=dict(
-                            action='updated',
-                            type=type_,
-                            query=query,
-                            update=u,
-                            object=obj))
-                    print u
+                    with self._stage(type_, index, 'write'):
+                        endpoint[existing[0]] = obj
+                    self._outcome('updated', type_, query, obj, u)
                 else:
-                    self.logger.info(
-                        'no change %s %s', type_.upper(), query,
-                        extra=dict(
-                            action='no change',
-                            type=type_,
-                            query=query,
-                            object=obj))
+                    self._outcome('no change', type_, query, obj)
                 return existing[0]
             else:
-                r = endpoint.create(obj)
-                self.logger.info(
-                    'created %s %s', type_.upper(), query,
-                    extra=dict(
-                        action='created',
-                        type=type_,
-                        query=query,
-                        object=obj))
+                with self._stage(type_, index, 'write'):
+                    r = endpoint.create(obj)
+                self._outcome('created', type_, query, obj)
                 return r
         except KeyboardInterrupt:
             raise
         except:
-            self.logger.error(
-                'error %s %s\nobject: %s', type_.upper(), query, obj,
-                exc_info=True,
-                extra=dict(
-                    action='error',
-                    type=type_,
-                    query=query,
-                    object=obj))
+            self._outcome('error', type_, query, obj)
+
+    def _upsert_pending(self, type_, query, obj, index):
+        key = (type_, tuple(sorted(query.iteritems())))
+        endpoint = self.sr[type_]
+        try:
+            with self._object_lock(key):
+                pending = self._cached(key)
+                if pending is None:
+                    with self._stage(type_, index, 'lookup'):
+                        existing = endpoint.filter(**query)[:1]
+                    if not existing:
+                        with self._stage(type_, index, 'write'):
+                            r = endpoint.create(obj)
+                        self._outcome('created', type_, query, obj)
+                        self._remember(key, _Pending(r, index))
+                        return r
+                    pending = _Pending(existing[0], index)
+                    self._remember(key, pending)
+                pending.merge(obj)
+                with self._stage(type_, index, 'diff'):
+                    u = self.get_update(pending.existing, pending.merged)
+                with self._lock:
+                    if u:
+                        self._dirty[key] = pending
+                        changed = True
+                    else:
+                        changed = key in self._dirty
+                        if not changed:
+                            # nothing to write, so it can be forgotten
+                            pending.merged = {}
+                    full = len(self._dirty) >= self.chunk_size
+                if not changed:
+                    self._outcome('no change', type_, query, obj)
+                existing = pending.existing
+            # flush after letting go of this object, since flushing takes
+            # the lock of every pending object in turn
+            if full:
+                self.flush()
+            return existing
+        except KeyboardInterrupt:
+            raise
+        except:
+            self._outcome('error', type_, query, obj)
+
+    def flush(self, pool=None):
+        """
+        Writes the merged changes to every object with pending updates.
+        Only used with `coalesce=True`.  With a `pool` (such as a
+        `multiprocessing.pool.ThreadPool`), the objects are written in
+        parallel.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, OrderedDict()
+        if pool is None:
+            for item in dirty.iteritems():
+                self._write_pending(item)
+        else:
+            for _ in pool.imap_unordered(self._write_pending,
+                                         dirty.iteritems()):
+                pass
+
+    def _write_pending(self, (key, pending)):
+        type_, query = key
+        query = dict(query)
+        try:
+            with self._object_lock(key):
+                obj, pending.merged = pending.merged, {}
+                if not obj:
+                    # another thread's flush already wrote it
+                    return
+                with self._stage(type_, pending.index, 'write'):
+                    pending.existing = self.sr[type_].update(
+                        pending.existing, **obj)
+            self._outcome('updated', type_, query, obj)
+        except KeyboardInterrupt:
+            raise
+        except:
+            self._outcome('error', type_, query, obj)
+
+
+def _exception():
+    """
+    Describes the exception being handled, for `Outcomes`.
+    """
+    e = sys.exc_info()[1]
+    return '%s: %s' % (type(e).__name__, e)
+
+
+class _Pending(object):
+    """
+    An object seen while coalescing: the object as the API last returned
+    it, and the (merged) data from our rows which hasn't been written yet.
+    """
+    __slots__ = ('existing', 'merged', 'index')
+
+    def __init__(self, existing, index):
+        self.existing = existing
+        self.merged = {}
+        self.index = index
+
+    def merge(self, obj):
+        self.merged = _merge(self.merged, obj)
+
+
+def _merge(old, new):
+    """
+    Merges `new` into `old`: dictionaries are merged recursively, and
+    anything else in `new` replaces what was in `old`.
+    """
+    if not (isinstance(old, dict) and isinstance(new, dict)):
+        return new
+    merged = dict(old)
+    for k, v in new.iteritems():
+        merged[k] = _merge(old.get(k), v)
+    return merged
+
+
+class _NoStage(object):
+    """
+    Stand-in for `studentrecord.profiling.Stage` when we're not profiling.
+    """
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_no_stage = _NoStage()
@@ -1,13 +1,59 @@
-try:
-    import jinja2
-except ImportError:
-    jinja2 = None  # noqa
-try:
-    import dateutil
-except ImportError:
-    dateutil = None
-else:
-    import dateutil.parser
+import importlib
+
+# jinja2 and dateutil are optional, and slow to import, so they're imported
+# the first time they're needed
+_missing = object()
+_modules = {}
+
+# compiled templates are kept in a single environment; see
+# `set_template_cache()`
+_environment = None
+_template_cache_dir = None
+
+
+def _import(name):
+    """
+    Returns the given module, or None if it isn't installed.
+    """
+    module = _modules.get(name, _missing)
+    if module is _missing:
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            module = None
+        _modules[name] = module
+    return module
+
+
+def set_template_cache(directory):
+    """
+    Stores compiled Jinja2 templates in `directory`, so later runs with the
+    same templates don't have to compile them again.
+    """
+    global _environment, _template_cache_dir
+    _template_cache_dir = directory
+    _environment = None
+
+
+def template(source):
+    """
+    Returns the compiled Jinja2 template for `source`, compiling it only the
+    first time it's used.
+    """
+    global _environment
+    if _environment is None:
+        jinja2 = _import('jinja2')
+        if _template_cache_dir:
+            bytecode_cache = jinja2.FileSystemBytecodeCache(
+                _template_cache_dir)
+        else:
+            bytecode_cache = None
+        # templates are "loaded" by their source, so they're cached by it
+        _environment = jinja2.Environment(
+            loader=jinja2.FunctionLoader(lambda name: name),
+            bytecode_cache=bytecode_cache,
+            cache_size=-1)
+    return _environment.get_template(source)
 
 
 class Mapping(object):
@@ -32,6 +78,21 @@ class Mapping(object):
     def __repr__(self):
         return str(self)
 
+    def templates(self, o=_missing):
+        """
+        Yields the Jinja2 template strings used by this mapping.
+        """
+        if o is _missing:
+            o = self.mapping
+        if isinstance(o, dict):
+            o = o.values()
+        if isinstance(o, (list, tuple)):
+            for i in o:
+                for t in self.templates(i):
+                    yield t
+        elif isinstance(o, basestring) and '{' in o:
+            yield o
+
     def __call__(self, *rows):
         """
         Build a dictionary for the given row(s).  If passed a single row, just
@@ -72,11 +133,10 @@ class Mapping(object):
 
     @staticmethod
     def _build_str(row, name, o):
-        if jinja2 and '{' in o:
-            template = jinja2.Template(o)
-            o = template.render(row=row,
-                                min=min,
-                                max=max)
+        if '{' in o and _import('jinja2'):
+            o = template(o).render(row=row,
+                                   min=min,
+                                   max=max)
         if '[' in o and o not in row:
             # if we didn't create the given related object, don't give back the
             # string
@@ -92,9 +152,9 @@ class Mapping(object):
             o = False
         elif o == 'None':
             return None
-        elif dateutil and '-' in o or '/' in o:
+        elif ('-' in o or '/' in o) and _import('dateutil.parser'):
             try:
-                o = dateutil.parser.parse(o).isoformat()
+                o = _import('dateutil.parser').parse(o).isoformat()
             except:
                 pass
         return o
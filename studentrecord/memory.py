@@ -0,0 +1,245 @@
+"""
+Memory instrumentation for long-running imports and exports.
+
+>>> monitor = MemoryMonitor(interval=60, rss_limit=2 * 1024 ** 3)
+>>> monitor.track('importer', importer.cache_sizes)
+>>> monitor.start()
+>>> importer(rows)
+>>> monitor.stop()
+>>> monitor.report()
+
+Every `interval` seconds, a background thread takes a sample: the
+process's resident set size (RSS), the size of each tracked cache, and the
+places where memory grew the most since the previous sample.  Each sample
+is logged (at INFO, on the 'studentrecord.memory' logger), and a warning is
+logged whenever RSS is over `rss_limit` bytes, so slow leaks show up in the
+logs of production runs.
+
+Growth is measured with tracemalloc, by the line which allocated the
+memory, if it's available (Python 3, or a Python 2 patched for
+pytracemalloc).  Otherwise it's measured by counting the objects of each
+type the garbage collector knows about, which is slower (a second or so for
+millions of objects) and only gives counts, not sizes.
+"""
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+
+def rss():
+    """
+    Returns the resident set size of this process in bytes, or None if we
+    can't tell.  Without /proc, this is the peak size rather than the
+    current one.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _tracemalloc():
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    return tracemalloc
+
+
+def _type_counts():
+    counts = defaultdict(int)
+    for o in gc.get_objects():
+        counts[type(o).__name__] += 1
+    return counts
+
+
+def _megabytes(size):
+    return size / (1024.0 * 1024)
+
+
+class MemoryMonitor(object):
+    """
+    Samples memory use every `interval` seconds once `start()`ed, keeping
+    the last `history` samples in `samples`.  Each sample is a dictionary
+    with the time, rss, the size of each tracked cache, and `growth`: the
+    `top` places memory grew most since the previous sample, as (place,
+    bytes, count) tuples (bytes are None without tracemalloc).  Pass
+    `allocations=False` to only sample RSS and caches.
+    """
+    log_name = 'studentrecord.memory'
+
+    def __init__(self, interval=60, rss_limit=None, top=10, history=1000,
+                 allocations=True, frames=1):
+        self.logger = logging.getLogger(self.log_name)
+        self.interval = interval
+        self.rss_limit = rss_limit
+        self.top = top
+        self.allocations = allocations
+        self.frames = frames
+        self.samples = deque(maxlen=history)
+        self.peak_rss = None
+        self.caches = []
+        self._tracemalloc = _tracemalloc() if allocations else None
+        self._first = self._previous = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def track(self, name, size):
+        """
+        Includes a cache in each sample.  `size` is called with no arguments
+        and returns its size (such as `len(cache)`), or a dictionary of
+        sizes, which are reported as 'name.key'.
+        """
+        self.caches.append((name, size))
+
+    def start(self):
+        if self._tracemalloc is not None and not (
+                self._tracemalloc.is_tracing()):
+            self._tracemalloc.start(self.frames)
+        self._first = self._previous = self._allocations()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops sampling, after taking a last sample.
+        """
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        self.sample()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:
+                self.logger.error('while sampling memory', exc_info=True)
+
+    def _allocations(self):
+        if not self.allocations:
+            return None
+        if self._tracemalloc is not None:
+            return self._tracemalloc.take_snapshot()
+        return _type_counts()
+
+    def _growth(self, old, new):
+        if old is None or new is None:
+            return []
+        if self._tracemalloc is not None:
+            stats = new.compare_to(old, 'lineno')
+            return [(str(s.traceback[0]), s.size_diff, s.count_diff)
+                    for s in stats[:self.top] if s.size_diff > 0]
+        growth = [(name, None, count - old.get(name, 0))
+                  for (name, count) in new.iteritems()]
+        growth.sort(key=lambda g: g[2], reverse=True)
+        return [g for g in growth[:self.top] if g[2] > 0]
+
+    def _cache_sizes(self):
+        sizes = {}
+        for name, size in self.caches:
+            try:
+                value = size()
+            except Exception:
+                self.logger.error('while measuring %s', name, exc_info=True)
+                continue
+            if isinstance(value, dict):
+                for key, v in value.iteritems():
+                    sizes['%s.%s' % (name, key)] = v
+            else:
+                sizes[name] = value
+        return sizes
+
+    def sample(self):
+        """
+        Takes (and logs) a sample now, and returns it.
+        """
+        current = rss()
+        if current is not None:
+            self.peak_rss = max(self.peak_rss, current)
+        caches = self._cache_sizes()
+        allocations = self._allocations()
+        growth = self._growth(self._previous, allocations)
+        if allocations is not None:
+            self._previous = allocations
+        sample = dict(time=time.time(), rss=current, caches=caches,
+                      growth=growth)
+        self.samples.append(sample)
+        self._log(sample)
+        return sample
+
+    def _log(self, sample):
+        pid = os.getpid()
+        current = sample['rss']
+        if (current is not None and self.rss_limit is not None and
+                current > self.rss_limit):
+            self.logger.warning(
+                'memory [pid %i]: RSS %.1f MB is over the limit of %.1f MB',
+                pid, _megabytes(current), _megabytes(self.rss_limit),
+                extra=dict(action='rss_limit', rss=current,
+                           limit=self.rss_limit))
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        caches = ', '.join('%s=%i' % item
+                           for item in sorted(sample['caches'].iteritems()))
+        self.logger.info(
+            'memory [pid %i]: RSS %s%s%s', pid,
+            '?' if current is None else '%.1f MB' % _megabytes(current),
+            '; ' if caches else '', caches,
+            extra=dict(action='memory', rss=current,
+                       caches=sample['caches']))
+        for place, size, count in sample['growth']:
+            if size is None:
+                self.logger.info('memory [pid %i]:   %+i %s objects', pid,
+                                 count, place)
+            else:
+                self.logger.info('memory [pid %i]:   %+.1f KB in %+i objects '
+                                 'at %s', pid, size / 1024.0, count, place)
+
+    def report(self, stream=None):
+        """
+        Writes a summary to `stream` (default stdout): peak RSS, the last
+        and largest size of each cache, and where memory grew most since
+        `start()`.
+        """
+        stream = stream or sys.stdout
+        if self.peak_rss is not None:
+            stream.write('Peak RSS: %.1f MB\n' % _megabytes(self.peak_rss))
+        peaks = defaultdict(int)
+        for sample in self.samples:
+            for name, size in sample['caches'].iteritems():
+                peaks[name] = max(peaks[name], size)
+        if peaks:
+            last = self.samples[-1]['caches']
+            stream.write('%-30s %12s %12s\n' % ('cache', 'last', 'peak'))
+            for name in sorted(peaks):
+                stream.write('%-30s %12i %12i\n' % (name, last.get(name, 0),
+                                                    peaks[name]))
+        growth = self._growth(self._first, self._previous)
+        if growth:
+            stream.write('Largest growth since the start:\n')
+            for place, size, count in growth:
+                stream.write('%12s %+10i  %s\n' % (
+                    '' if size is None else '%+.1f KB' % (size / 1024.0),
+                    count, place))
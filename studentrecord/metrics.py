@@ -0,0 +1,165 @@
+"""
+Request metrics for `studentrecord.StudentRecord`.
+
+>>> sr = StudentRecord(auth, metrics=Metrics())
+>>> ...
+>>> sr.metrics.snapshot()['requests']
+[{'method': 'get', 'endpoint': 'school', 'status': 200, 'count': 1520,
+  'seconds': 61.2, ...}, ...]
+>>> print sr.metrics.prometheus()
+
+Other parts of the library (the replica, for example) count events such as
+cache hits with `Metrics.event()`.
+"""
+import threading
+from collections import defaultdict
+
+# upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class RequestStats(object):
+    """
+    Counters for one (method, endpoint, status) combination.
+    """
+    def __init__(self, buckets):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.uncompressed_bytes_sent = 0
+        self.uncompressed_bytes_received = 0
+        self.buckets = [0] * len(buckets)
+
+
+class Metrics(object):
+    """
+    Thread-safe counters and latency histograms for API requests, keyed by
+    (method, endpoint, status).  Requests which fail without a response
+    have a status of 'error'.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.lock = threading.Lock()
+        self.bucket_bounds = tuple(buckets)
+        self.requests = {}
+        self.events = defaultdict(int)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def record_request(self, method, endpoint, status, seconds, bytes_sent=0,
+                       bytes_received=0, uncompressed_bytes_sent=None,
+                       uncompressed_bytes_received=None):
+        """
+        Records one request.  Byte counts are as sent over the network; the
+        uncompressed counts default to the same.
+        """
+        if uncompressed_bytes_sent is None:
+            uncompressed_bytes_sent = bytes_sent
+        if uncompressed_bytes_received is None:
+            uncompressed_bytes_received = bytes_received
+        key = (method, endpoint, status)
+        with self.lock:
+            stats = self.requests.get(key)
+            if stats is None:
+                stats = self.requests[key] = RequestStats(self.bucket_bounds)
+            stats.count += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            stats.uncompressed_bytes_sent += uncompressed_bytes_sent
+            stats.uncompressed_bytes_received += uncompressed_bytes_received
+            for i, bound in enumerate(self.bucket_bounds):
+                if seconds <= bound:
+                    stats.buckets[i] += 1
+                    break
+
+    def event(self, name, endpoint=None, count=1):
+        """
+        Counts a named event (such as 'cache_hit' or 'retry'), optionally
+        for a single endpoint.
+        """
+        with self.lock:
+            self.events[(name, endpoint)] += count
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.events = defaultdict(int)
+
+    def snapshot(self):
+        """
+        Returns a copy of the current metrics as plain data, suitable for
+        JSON.  Histogram buckets are cumulative, as in Prometheus.
+        """
+        with self.lock:
+            requests = []
+            for (method, endpoint, status), stats in sorted(
+                    self.requests.iteritems()):
+                cumulative = []
+                total = 0
+                for bound, count in zip(self.bucket_bounds, stats.buckets):
+                    total += count
+                    cumulative.append((bound, total))
+                requests.append(dict(
+                    method=method,
+                    endpoint=endpoint,
+                    status=status,
+                    count=stats.count,
+                    seconds=stats.seconds,
+                    max_seconds=stats.max_seconds,
+                    bytes_sent=stats.bytes_sent,
+                    bytes_received=stats.bytes_received,
+                    uncompressed_bytes_sent=stats.uncompressed_bytes_sent,
+                    uncompressed_bytes_received=(
+                        stats.uncompressed_bytes_received),
+                    buckets=cumulative))
+            events = [dict(name=name, endpoint=endpoint, count=count)
+                      for ((name, endpoint), count) in
+                      sorted(self.events.iteritems())]
+        return dict(requests=requests, events=events)
+
+    def prometheus(self, prefix='studentrecord'):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = [
+            '# TYPE %s_request_seconds histogram' % prefix,
+        ]
+        for r in snapshot['requests']:
+            labels = 'method="%s",endpoint="%s",status="%s"' % (
+                r['method'], r['endpoint'], r['status'])
+            for bound, count in r['buckets']:
+                lines.append('%s_request_seconds_bucket{%s,le="%s"} %i' % (
+                    prefix, labels, bound, count))
+            lines.append('%s_request_seconds_bucket{%s,le="+Inf"} %i' % (
+                prefix, labels, r['count']))
+            lines.append('%s_request_seconds_sum{%s} %f' % (
+                prefix, labels, r['seconds']))
+            lines.append('%s_request_seconds_count{%s} %i' % (
+                prefix, labels, r['count']))
+        for name in ('bytes_sent', 'bytes_received',
+                     'uncompressed_bytes_sent',
+                     'uncompressed_bytes_received'):
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            for r in snapshot['requests']:
+                lines.append(
+                    '%s_%s_total{method="%s",endpoint="%s",status="%s"} %i' % (
+                        prefix, name, r['method'], r['endpoint'],
+                        r['status'], r[name]))
+        lines.append('# TYPE %s_events_total counter' % prefix)
+        for e in snapshot['events']:
+            lines.append('%s_events_total{name="%s",endpoint="%s"} %i' % (
+                prefix, e['name'], e['endpoint'] or '', e['count']))
+        return '\n'.join(lines) + '\n'
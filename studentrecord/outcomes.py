@@ -0,0 +1,180 @@
+"""
+Outcomes of an import: what `studentrecord.importer.Importer` did with
+each object it built.
+
+>>> outcomes = Outcomes(sink=open('outcomes.ndjson', 'w'),
+...                     sample={'no change': 0.01})
+>>> importer = Importer(sr, mappings, outcomes=outcomes)
+>>> importer(rows)
+>>> outcomes.close()
+>>> outcomes.report()
+
+Every outcome is counted by (type, action), where the action is one of
+`ACTIONS`.  With a `sink`, each outcome is also written to it as a line of
+JSON, by a background thread, so the importer never waits on the file:
+events wait in a queue of at most `queue_size`, and if that fills up
+further events are counted in `dropped` rather than written.  If writing
+to the sink fails (the disk is full, say), the error is kept in `error`
+and the rest of the events are dropped as well; the counts are still
+kept.  `sample` maps actions to the fraction of their events to write; by
+default every event is written.
+"""
+import Queue
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from studentrecord.codec import JSONCodec
+
+ACTIONS = ('created', 'updated', 'no change', 'error')
+
+_STOP = object()
+
+
+class Outcomes(object):
+    """
+    Thread-safe counters of import outcomes, with an optional NDJSON sink
+    (any object with `write()`).  Call `close()` when the import is done
+    to write the queued events.
+    """
+
+    def __init__(self, sink=None, sample=None, queue_size=10000,
+                 codec=None):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.dropped = 0
+        self.error = None
+        self.sink = sink
+        self.sample = dict(sample or {})
+        self.codec = codec or JSONCodec()
+        self._random = random.random
+        self._queue = None
+        self._thread = None
+        if sink is not None:
+            self._queue = Queue.Queue(queue_size)
+            self._thread = threading.Thread(target=self._write)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def record(self, type_, action, query=None, obj=None, update=None,
+               error=None):
+        """
+        Counts one outcome, and queues it for the sink (if there is one,
+        and the event is sampled).  The objects are encoded later, so they
+        shouldn't be changed after they're recorded.
+        """
+        with self.lock:
+            self.counts[(type_, action)] += 1
+        if self._queue is None:
+            return
+        rate = self.sample.get(action)
+        if rate is not None and self._random() >= rate:
+            return
+        if self.error is not None:
+            self._drop(1)
+            return
+        try:
+            self._queue.put_nowait(
+                (time.time(), type_, action, query, obj, update, error))
+        except Queue.Full:
+            self._drop(1)
+
+    def _drop(self, count, error=None):
+        with self.lock:
+            self.dropped += count
+            if error is not None and self.error is None:
+                self.error = error
+
+    def _write(self):
+        queue = self._queue
+        while True:
+            events = [queue.get()]
+            # write whatever else has arrived in one go
+            try:
+                while len(events) < 1000:
+                    events.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+            stop = _STOP in events
+            if stop:
+                events.remove(_STOP)
+            if self.error is not None:
+                # keep draining the queue, so record() and close() never
+                # wait on it
+                self._drop(len(events))
+            elif events:
+                try:
+                    self.sink.write(''.join(self._encode(e) for e in events))
+                except Exception as e:
+                    self._drop(len(events), '%s: %s' % (type(e).__name__, e))
+            if stop:
+                return
+
+    def _encode(self, (when, type_, action, query, obj, update, error)):
+        event = dict(time=when, type=type_, action=action)
+        if query is not None:
+            event['query'] = query
+        if update is not None:
+            event['update'] = update
+        if obj is not None:
+            event['object'] = obj
+        if error is not None:
+            event['error'] = error
+        return self.codec.dumps(event) + '\n'
+
+    def close(self):
+        """
+        Writes any queued events and stops the background thread.
+        """
+        if self._thread is None:
+            return
+        # don't wait forever if the thread has died
+        while self._thread.is_alive():
+            try:
+                self._queue.put(_STOP, timeout=1)
+                break
+            except Queue.Full:
+                pass
+        self._thread.join()
+        self._thread = None
+        self._queue = None
+        flush = getattr(self.sink, 'flush', None)
+        if flush is not None and self.error is None:
+            try:
+                flush()
+            except Exception as e:
+                self.error = '%s: %s' % (type(e).__name__, e)
+
+    def summary(self):
+        """
+        Returns a list of dictionaries, one per type, with a count for each
+        action.
+        """
+        with self.lock:
+            counts = dict(self.counts)
+        rows = {}
+        for (type_, action), count in counts.iteritems():
+            row = rows.get(type_)
+            if row is None:
+                row = rows[type_] = dict((a, 0) for a in ACTIONS)
+                row['type'] = type_
+            row[action] = row.get(action, 0) + count
+        return [rows[type_] for type_ in sorted(rows)]
+
+    def report(self, stream=None):
+        """
+        Writes a table of the counts to `stream` (default stdout).
+        """
+        stream = stream or sys.stdout
+        stream.write('%-14s' % 'type' +
+                     ''.join(' %9s' % a for a in ACTIONS) + '\n')
+        for row in self.summary():
+            stream.write('%-14s' % row['type'] +
+                         ''.join(' %9i' % row[a] for a in ACTIONS) + '\n')
+        if self.error is not None:
+            stream.write('(%i events not written: %s)\n' % (self.dropped,
+                                                            self.error))
+        elif self.dropped:
+            stream.write('(%i events not written: the queue was full)\n' %
+                         self.dropped)
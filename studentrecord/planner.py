@@ -0,0 +1,104 @@
+"""
+Estimates the cost of an import without talking to the API.
+
+>>> planner = Planner(mappings)
+>>> planner(rows)
+>>> planner.report(latency=0.1, concurrency=4)
+
+The planner runs the real `Mapping` objects over every row, counting the
+objects each type would get and how many distinct lookups they come to.
+Whether an object already exists (and whether it changed) can't be known
+without the API, so lookups (GETs) and writes (POSTs and PUTs) are counted
+separately: the lookups are known exactly, but anything from none to every
+object may need writing.
+"""
+import sys
+from collections import defaultdict
+from studentrecord.importer import Importer
+
+
+class Planner(Importer):
+    """
+    An `Importer` which records what it would have done.  `dropped` maps
+    (type, mapping index) to the (1-based) numbers of the rows for which
+    `_required` fields were missing.
+    """
+
+    def __init__(self, mappings):
+        Importer.__init__(self, None, mappings)
+        self.rows = 0
+        self.objects = defaultdict(int)
+        self.unqueryable = defaultdict(int)
+        self.queries = defaultdict(set)
+        self.dropped = defaultdict(list)
+
+    def _build_row(self, row):
+        self.rows += 1
+        Importer._build_row(self, row)
+
+    def _dropped(self, type_, index, row):
+        self.dropped[type_, index].append(self.rows)
+
+    def upsert(self, type_, obj, index=None):
+        query = self.query_for_obj(obj)
+        if not query:
+            self.unqueryable[type_] += 1
+            return
+        self.objects[type_] += 1
+        self.queries[type_].add(tuple(sorted(query.iteritems())))
+        # stand in for the ID, so that `type[_key]` references resolve
+        return dict(id='%s:planned' % type_)
+
+    def estimate(self, coalesce=False):
+        """
+        Returns (lookups, writes) for the import: the number of GETs, and
+        the most POSTs and PUTs it could need (the fewest is 0).  Without
+        coalescing, every object is looked up and possibly written; with
+        it, every distinct object is.
+        """
+        if coalesce:
+            count = sum(len(q) for q in self.queries.itervalues())
+        else:
+            count = sum(self.objects.itervalues())
+        return count, count
+
+    def report(self, latency=0.1, concurrency=1, stream=None, max_rows=20):
+        """
+        Writes a summary of the plan to `stream` (default stdout).  Times
+        assume each request takes `latency` seconds, with `concurrency`
+        requests in flight at once.
+        """
+        stream = stream or sys.stdout
+        stream.write('Rows: %i\n\n' % self.rows)
+        stream.write('%-14s %9s %9s %9s\n' % ('type', 'objects', 'distinct',
+                                               'no name'))
+        types = sorted(set(self.objects) | set(self.unqueryable))
+        for type_ in types:
+            stream.write('%-14s %9i %9i %9i\n' % (
+                type_, self.objects[type_], len(self.queries[type_]),
+                self.unqueryable[type_]))
+        stream.write('\n')
+        for coalesce in (False, True):
+            lookups, writes = self.estimate(coalesce)
+            stream.write(
+                '%s: %i lookups and 0-%i writes, %s-%s at %gms latency and '
+                'concurrency %i\n' % (
+                    'With --coalesce' if coalesce else 'Without coalescing',
+                    lookups, writes,
+                    _duration(lookups * latency / concurrency),
+                    _duration((lookups + writes) * latency / concurrency),
+                    latency * 1000, concurrency))
+        if self.dropped:
+            stream.write('\nObjects dropped by _required:\n')
+            for (type_, index), rows in sorted(self.dropped.iteritems()):
+                shown = ', '.join(str(r) for r in rows[:max_rows])
+                if len(rows) > max_rows:
+                    shown += ', ...'
+                stream.write('* %s mapping %i: %i rows (%s)\n' % (
+                    type_, index, len(rows), shown))
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%i:%02i:%02i' % (hours, minutes, seconds)
@@ -0,0 +1,154 @@
+"""
+Profiling for `studentrecord.importer.Importer`.
+
+>>> profile = Profile()
+>>> importer = Importer(sr, mappings, profile=profile)
+>>> importer(rows)
+>>> profile.report()
+
+Time is broken down by (type, mapping index, stage), where the stages are:
+
+* render: building the object from the row with its `Mapping`
+* lookup: looking for an existing object
+* diff: comparing the existing object with the new one
+* write: creating or updating the object
+
+A `Profile` can be shared by importers running in several threads: each
+stage counts only the requests made by its own thread.  CPU time is that
+of the whole process, though, so it's only meaningful when the importer
+isn't sharing the process with other threads.
+"""
+import json
+import sys
+import threading
+import time
+
+STAGES = ('render', 'lookup', 'diff', 'write')
+
+
+class StageStats(object):
+    """
+    Accumulated times for one (type, mapping index, stage).
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.requests = 0
+
+
+class Stage(object):
+    """
+    Context manager which times a single stage.
+    """
+    __slots__ = ('profile', 'stats', 'wall', 'cpu', 'requests')
+
+    def __init__(self, profile, stats):
+        self.profile = profile
+        self.stats = stats
+
+    def __enter__(self):
+        self.requests = self.profile.thread_requests()
+        self.cpu = time.clock()
+        self.wall = time.time()
+
+    def __exit__(self, *exc_info):
+        wall = time.time() - self.wall
+        cpu = time.clock() - self.cpu
+        requests = self.profile.thread_requests() - self.requests
+        stats = self.stats
+        with self.profile.lock:
+            stats.wall += wall
+            stats.cpu += cpu
+            stats.requests += requests
+            stats.calls += 1
+
+
+class Profile(object):
+    """
+    Accumulates wall time, CPU time, call counts and API request counts for
+    each stage of an import.  Requests are counted with a 'post_request'
+    hook (see `StudentRecord.add_hook`), added by `attach()`.  Thread-safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.requests = 0
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock'], state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    def attach(self, sr):
+        """
+        Counts the requests made through `sr`.
+        """
+        add_hook = getattr(sr, 'add_hook', None)
+        if add_hook is not None:
+            add_hook('post_request', self._count_request)
+
+    def _count_request(self, info):
+        # hooks run in the thread which made the request
+        self._local.requests = self.thread_requests() + 1
+        with self.lock:
+            self.requests += 1
+
+    def thread_requests(self):
+        """
+        Returns the number of requests counted in the current thread.
+        """
+        return getattr(self._local, 'requests', 0)
+
+    def stage(self, type_, index, stage):
+        key = (type_, index, stage)
+        stats = self.stats.get(key)
+        if stats is None:
+            with self.lock:
+                stats = self.stats.setdefault(key, StageStats())
+        return Stage(self, stats)
+
+    def summary(self):
+        """
+        Returns a list of dictionaries, one per (type, mapping index, stage),
+        ordered by decreasing wall time.
+        """
+        with self.lock:
+            rows = [dict(type=type_, mapping=index, stage=stage,
+                         calls=stats.calls, wall=stats.wall, cpu=stats.cpu,
+                         requests=stats.requests)
+                    for ((type_, index, stage), stats)
+                    in self.stats.iteritems()]
+        rows.sort(key=lambda r: r['wall'], reverse=True)
+        return rows
+
+    def report(self, stream=None, limit=None):
+        """
+        Writes a ranked table of the summary to `stream` (default stdout).
+        """
+        stream = stream or sys.stdout
+        rows = self.summary()
+        total = sum(r['wall'] for r in rows) or 1
+        stream.write('%-14s %7s %-7s %9s %9s %9s %9s %6s\n' % (
+            'type', 'mapping', 'stage', 'calls', 'wall', 'cpu', 'requests',
+            '%'))
+        for r in rows[:limit]:
+            # the index is None for objects upserted directly
+            mapping = '-' if r['mapping'] is None else r['mapping']
+            stream.write('%-14s %7s %-7s %9i %9.3f %9.3f %9i %5.1f%%\n' % (
+                r['type'], mapping, r['stage'], r['calls'], r['wall'],
+                r['cpu'], r['requests'], 100.0 * r['wall'] / total))
+
+    def dump(self, fp):
+        """
+        Writes the summary to the given file as JSON.
+        """
+        json.dump(self.summary(), fp, indent=2)
@@ -0,0 +1,168 @@
+"""
+Compact, read-only representations of the objects returned by the API.
+
+A full scan of an endpoint can hold tens of thousands of objects in memory,
+and a plain dictionary (plus one for every nested object) carries a lot of
+overhead per object.  `RecordFactory` turns decoded JSON into `Record`
+instances instead: each distinct set of keys gets its own `__slots__` class,
+so the key names are stored once per class rather than once per object.
+
+>>> factory = RecordFactory()
+>>> r = factory({'name': {'first': 'Jane', 'last': 'Doe'}, 'id': 'abc'})
+>>> r['name']['first']
+'Jane'
+>>> r.to_dict()
+{'id': 'abc', 'name': {'first': 'Jane', 'last': 'Doe'}}
+"""
+from collections import Mapping
+
+
+class Record(object):
+    """
+    Base class for the generated record classes.  Records support the
+    read-only half of the dictionary interface, so they can be passed
+    anywhere the API's dictionaries are read (`Importer.get_update`, for
+    example).  Use `to_dict()` to get a mutable copy.
+    """
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        return self._index[key].__get__(self)
+
+    def get(self, key, default=None):
+        descriptor = self._index.get(key)
+        if descriptor is None:
+            return default
+        return descriptor.__get__(self)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def keys(self):
+        return list(self._fields)
+
+    iterkeys = __iter__
+
+    def values(self):
+        return list(self.itervalues())
+
+    def itervalues(self):
+        for key in self._fields:
+            yield self._index[key].__get__(self)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iteritems(self):
+        for key in self._fields:
+            yield key, self._index[key].__get__(self)
+
+    def to_dict(self):
+        """
+        Returns a (deep) copy of this record as regular dictionaries and
+        lists.
+        """
+        return to_dict(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return self.to_dict() == to_dict(other)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # the generated classes can't be pickled by name, so rebuild them
+        # from their data on the other side (multiprocessing, for example)
+        return (_restore, (self.to_dict(),))
+
+    def __repr__(self):
+        return 'Record(%r)' % (self.to_dict(),)
+
+
+Mapping.register(Record)
+
+
+class RecordFactory(object):
+    """
+    Builds `Record` objects from decoded JSON.  Record classes are derived
+    from the keys of each object and cached, and key strings are interned so
+    every record shares the same key objects.  Lists are kept as lists so
+    callers checking for them still work.
+    """
+
+    def __init__(self):
+        self.classes = {}
+        self.keys = {}
+
+    def __call__(self, o):
+        if isinstance(o, dict):
+            cls = self.record_class(o)
+            record = cls.__new__(cls)
+            for key, descriptor in cls._index.iteritems():
+                descriptor.__set__(record, self(o[key]))
+            return record
+        elif isinstance(o, list):
+            return [self(i) for i in o]
+        return o
+
+    def record_class(self, d):
+        """
+        Returns the (cached) `Record` subclass for the keys of the given
+        dictionary.
+        """
+        fields = tuple(sorted(d))
+        cls = self.classes.get(fields)
+        if cls is None:
+            fields = tuple(self.keys.setdefault(k, k) for k in fields)
+            slots = tuple('_%i' % i for i in range(len(fields)))
+            cls = type('Record', (Record,), dict(__slots__=slots,
+                                                 _fields=fields))
+            cls._index = dict(
+                (k, cls.__dict__[slot]) for (k, slot) in zip(fields, slots))
+            self.classes[fields] = cls
+        return cls
+
+
+def to_dict(o):
+    """
+    Recursively converts records (or any other mappings) into regular
+    dictionaries.
+    """
+    if isinstance(o, Mapping):
+        return dict((k, to_dict(v)) for (k, v) in o.iteritems())
+    elif isinstance(o, list):
+        return [to_dict(i) for i in o]
+    return o
+
+
+def json_default(o):
+    """
+    `default` hook for `json.dumps` so records can be sent back to the API.
+    """
+    if isinstance(o, Record):
+        return o.to_dict()
+    raise TypeError('%r is not JSON serializable' % (o,))
+
+
+default_factory = RecordFactory()
+
+
+def _restore(d):
+    return default_factory(d)
@@ -0,0 +1,323 @@
+"""
+A local, SQLite-backed copy of some of a customer's endpoints.
+
+Tools which read the same data over and over (looking up schools and
+organizations during an import, for example) can query a `Replica` instead
+of making a request for every lookup:
+
+>>> replica = Replica(sr, 'customer.db', endpoints=('school', 'person'))
+>>> replica.sync()
+>>> replica['school'].filter(ceeb='123456')[:1]
+[{'id': ..., 'ceeb': '123456', ...}]
+>>> importer = Importer(replica, mappings)
+
+Indexing the replica gives an object with the same interface as
+`studentrecord.Endpoint`.  Reads of replicated endpoints are answered
+locally; writes go to the API first and the result is stored locally, so
+the replica stays current with the changes made through it.  Endpoints that
+aren't replicated are passed straight through to the API.
+"""
+import fnmatch
+import json
+import sqlite3
+import threading
+from collections import Mapping
+from studentrecord import StudentRecordException, NotFound
+from studentrecord.records import json_default
+
+DEFAULT_ENDPOINTS = ('school', 'organization', 'person')
+
+# flattened field names (see `Importer.dict_to_query`) which get an index;
+# filters on other fields are checked against the stored objects instead
+DEFAULT_INDEXES = ('name', 'name__*', 'ceeb', 'key__*', 'location__state')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS objects (
+    endpoint TEXT NOT NULL,
+    id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (endpoint, id)
+);
+CREATE TABLE IF NOT EXISTS fields (
+    endpoint TEXT NOT NULL,
+    path TEXT NOT NULL,
+    value TEXT,
+    id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fields_lookup ON fields (endpoint, path, value);
+CREATE INDEX IF NOT EXISTS fields_object ON fields (endpoint, id);
+"""
+
+
+def flatten(o, prefix=''):
+    """
+    Yields (path, value) pairs for every scalar in the given object, using
+    the same `field__subfield` naming as `Importer.dict_to_query`.  Each item
+    of a list is yielded under the list's path.
+    """
+    if isinstance(o, Mapping):
+        for k, v in o.iteritems():
+            for item in flatten(v, '%s__%s' % (prefix, k) if prefix else k):
+                yield item
+    elif isinstance(o, list):
+        for v in o:
+            for item in flatten(v, prefix):
+                yield item
+    elif o is not None:
+        yield prefix, normalize(o)
+
+
+def normalize(value):
+    """
+    Values are compared as text, the same way they're sent to the API as
+    query arguments.
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+class Replica(object):
+    """
+    Replica keeps a copy of the given endpoints of the current customer of
+    `sr` in the SQLite database at `path`.  Call `sync()` to populate it.
+    """
+
+    def __init__(self, sr, path, endpoints=DEFAULT_ENDPOINTS,
+                 indexes=DEFAULT_INDEXES):
+        self.sr = sr
+        self.path = path
+        self.endpoints = tuple(endpoints)
+        self.indexes = tuple(indexes)
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        customer = self._meta('customer')
+        if customer is None:
+            self._set_meta('customer', sr.customer_id)
+        elif customer != sr.customer_id:
+            raise StudentRecordException(
+                '%s is a replica of customer %s, not %s' % (
+                    path, customer, sr.customer_id))
+
+    def __getitem__(self, endpoint):
+        if endpoint not in self.endpoints:
+            return self.sr[endpoint]
+        return ReplicaEndpoint(self, endpoint)
+
+    def close(self):
+        self.db.close()
+
+    def _meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key,)).fetchone()
+        return row and row[0]
+
+    def _set_meta(self, key, value):
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                    (key, value))
+
+    def _event(self, name, endpoint):
+        metrics = getattr(self.sr, 'metrics', None)
+        if metrics is not None:
+            metrics.event(name, endpoint)
+
+    def is_indexed(self, path):
+        return any(fnmatch.fnmatchcase(path, pattern)
+                   for pattern in self.indexes)
+
+    def sync(self, endpoints=None, full=False):
+        """
+        Brings the replica up to date with the API.  The first sync of an
+        endpoint (or any sync with `full=True`) copies every object.  Later
+        syncs only fetch the list of IDs, then download objects which were
+        added and drop objects which were removed.  Changes to existing
+        objects made other than through this replica are only picked up by a
+        full sync.
+        """
+        for endpoint in endpoints or self.endpoints:
+            if full or not self._meta('synced:%s' % endpoint):
+                self._sync_full(endpoint)
+            else:
+                self._sync_ids(endpoint)
+            self._set_meta('synced:%s' % endpoint, '1')
+
+    def _sync_full(self, endpoint):
+        objects = list(self.sr[endpoint])
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM objects WHERE endpoint = ?',
+                                (endpoint,))
+                self.db.execute('DELETE FROM fields WHERE endpoint = ?',
+                                (endpoint,))
+                for obj in objects:
+                    self._insert(endpoint, obj)
+
+    def _sync_ids(self, endpoint):
+        remote = set(obj['id'] for obj in
+                     self.sr[endpoint].filter(_fields='id'))
+        local = set(row[0] for row in self.db.execute(
+            'SELECT id FROM objects WHERE endpoint = ?', (endpoint,)))
+        added = [self.sr[endpoint][_id] for _id in remote - local]
+        with self.lock:
+            with self.db:
+                for _id in local - remote:
+                    self._delete(endpoint, _id)
+                for obj in added:
+                    self._insert(endpoint, obj)
+
+    def store(self, endpoint, obj):
+        """
+        Stores (or replaces) a single object.
+        """
+        with self.lock:
+            with self.db:
+                self._delete(endpoint, obj['id'])
+                self._insert(endpoint, obj)
+
+    def discard(self, endpoint, _id):
+        """
+        Removes a single object.
+        """
+        with self.lock:
+            with self.db:
+                self._delete(endpoint, _id)
+
+    def _insert(self, endpoint, obj):
+        _id = obj['id']
+        self.db.execute(
+            'INSERT INTO objects (endpoint, id, data) VALUES (?, ?, ?)',
+            (endpoint, _id, json.dumps(obj, default=json_default)))
+        self.db.executemany(
+            'INSERT INTO fields (endpoint, path, value, id) '
+            'VALUES (?, ?, ?, ?)',
+            [(endpoint, path, value, _id) for (path, value) in flatten(obj)
+             if self.is_indexed(path)])
+
+    def _delete(self, endpoint, _id):
+        self.db.execute('DELETE FROM objects WHERE endpoint = ? AND id = ?',
+                        (endpoint, _id))
+        self.db.execute('DELETE FROM fields WHERE endpoint = ? AND id = ?',
+                        (endpoint, _id))
+
+    def query(self, endpoint, filters, skip=0, limit=None):
+        """
+        Returns the list of objects at `endpoint` matching the given
+        ORM-style filters, in the order they were stored.
+        """
+        self._event('replica_hit', endpoint)
+        sql = ['SELECT data FROM objects WHERE endpoint = ?']
+        params = [endpoint]
+        remaining = {}
+        for path, value in filters.iteritems():
+            if path[0] == '_':
+                # API options such as `_fields`; not filters
+                continue
+            if self.is_indexed(path):
+                sql.append('AND id IN (SELECT id FROM fields WHERE '
+                           'endpoint = ? AND path = ? AND value = ?)')
+                params.extend((endpoint, path, normalize(value)))
+            else:
+                remaining[path] = normalize(value)
+        sql.append('ORDER BY rowid')
+        if not remaining:
+            sql.append('LIMIT ? OFFSET ?')
+            params.extend((-1 if limit is None else limit, skip))
+        with self.lock:
+            rows = self.db.execute(' '.join(sql), params).fetchall()
+        objects = (json.loads(row[0]) for row in rows)
+        if not remaining:
+            return list(objects)
+        matches = []
+        for obj in objects:
+            values = set(flatten(obj))
+            if all(item in values for item in remaining.iteritems()):
+                matches.append(obj)
+        end = None if limit is None else skip + limit
+        return matches[skip:end]
+
+    def get(self, endpoint, _id):
+        self._event('replica_hit', endpoint)
+        with self.lock:
+            row = self.db.execute(
+                'SELECT data FROM objects WHERE endpoint = ? AND id = ?',
+                (endpoint, _id)).fetchone()
+        if row is None:
+            raise NotFound('%s %s' % (endpoint, _id))
+        return json.loads(row[0])
+
+
+class ReplicaEndpoint(object):
+    """
+    The `studentrecord.Endpoint` interface, backed by a `Replica`.
+    """
+
+    def __init__(self, replica, endpoint, filters=None):
+        self.replica = replica
+        self.endpoint = endpoint
+        self.filters = filters or {}
+
+    def __iter__(self):
+        return iter(self.replica.query(self.endpoint, self.filters))
+
+    def exists(self, **filters):
+        filters = dict(self.filters, **filters)
+        return bool(self.replica.query(self.endpoint, filters, limit=1))
+
+    def filter(self, **kwargs):
+        if not kwargs:
+            return ReplicaEndpoint(self.replica, self.endpoint)
+        return ReplicaEndpoint(self.replica, self.endpoint,
+                               dict(self.filters, **kwargs))
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            skip = item.start or 0
+            limit = item.stop - skip if item.stop else 1000
+            return self.replica.query(self.endpoint, self.filters,
+                                      skip=skip, limit=limit)
+        elif isinstance(item, int):
+            data = self.replica.query(self.endpoint, self.filters,
+                                      skip=item, limit=1)
+            if data:
+                return data[0]
+            else:
+                raise IndexError
+        else:
+            return self.replica.get(self.endpoint, item)
+
+    def __setitem__(self, item, data):
+        response = self.update(item, **data)
+        if isinstance(item, dict):
+            item.update(response)
+
+    def __delitem__(self, item):
+        self.remove(item)
+
+    @property
+    def remote(self):
+        return self.replica.sr[self.endpoint]
+
+    def create(self, _data=None, **kwargs):
+        response = self.remote.create(_data, **kwargs)
+        self.replica.store(self.endpoint, response)
+        return response
+
+    def update(self, _data=None, **kwargs):
+        response = self.remote.update(_data, **kwargs)
+        self.replica.store(self.endpoint, response)
+        return response
+
+    def remove(self, _id):
+        response = self.remote.remove(_id)
+        if isinstance(_id, Mapping):
+            _id = _id['id']
+        self.replica.discard(self.endpoint, _id)
+        return response
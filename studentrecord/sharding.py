@@ -0,0 +1,322 @@
+"""
+Imports split across several processes, on one host or many, where each
+object is written by exactly one of them.
+
+Every shard reads and renders all of the rows, but only upserts the
+objects whose query hashes to it (see `shard_for()`), so no two shards can
+race to create the same school, and each shard's lookups (and coalescing)
+only ever cover its own objects.  When an object has a `_key` (so that
+later mappings can refer to it as `type[_key]`), its owner publishes the
+ID through a coordinator and the other shards wait for it there:
+
+>>> coordinator = SQLiteCoordinator('/tmp/import.coordination')
+>>> importer = ShardedImporter(sr, mappings, shard=0, shards=4,
+...                            coordinator=coordinator)
+>>> importer(rows)
+
+Shards work through the same rows in the same order, so a shard only waits
+for objects earlier in the row than the one it's on, which their owners
+reach without waiting on it.  If the owner can't create an object, it
+publishes the failure so the others don't wait forever.  An ID is only
+ever published once: a failure (from a later row) never replaces it, and
+an ID replaces an earlier failure.
+
+There are two coordinators:
+
+* `SQLiteCoordinator` uses a SQLite file, for processes on one host.
+* `SocketCoordinator` connects to a `CoordinatorServer`, for several hosts.
+  Run one with `python -m studentrecord.sharding HOST:PORT`.
+
+`coordinator()` builds one from an address: `tcp://HOST:PORT` or a
+filename.  Use a fresh file or server for each import.
+"""
+import SocketServer
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from studentrecord import StudentRecordException
+from studentrecord.importer import Importer
+
+# how long to wait for another shard to publish an ID, in seconds
+DEFAULT_TIMEOUT = 300
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ids (
+    key TEXT PRIMARY KEY,
+    id TEXT,
+    error TEXT
+);
+"""
+
+
+class ShardError(StudentRecordException):
+    """
+    Raised when another shard couldn't provide an object's ID.
+    """
+
+
+def object_key(type_, query):
+    """
+    The canonical name of the object of `type_` found by `query`, the same
+    in every process.
+    """
+    return json.dumps([type_, query], sort_keys=True, separators=(',', ':'))
+
+
+def shard_for(key, shards):
+    """
+    Which of `shards` owns the object with the given `object_key()`.
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest(), 16) % shards
+
+
+class ShardedImporter(Importer):
+    """
+    An `Importer` which only writes the objects owned by shard `shard` (of
+    `shards`, counting from 0), and gets the IDs of other shards' objects
+    from `coordinator`.  Waiting for an ID gives up after `timeout`
+    seconds.  Other keyword arguments are passed to `Importer`.
+    """
+
+    def __init__(self, sr, mappings, shard, shards, coordinator,
+                 timeout=DEFAULT_TIMEOUT, **kwargs):
+        if not 0 <= shard < shards:
+            raise ValueError('shard must be between 0 and %i' % (shards - 1))
+        Importer.__init__(self, sr, mappings, **kwargs)
+        self.shard = shard
+        self.shards = shards
+        self.coordinator = coordinator
+        self.timeout = timeout
+
+    def upsert(self, type_, obj, index=None):
+        if not self.sr:
+            return
+        query = self.query_for_obj(obj)
+        if not query:
+            return
+        key = object_key(type_, query)
+        if shard_for(key, self.shards) == self.shard:
+            r = Importer.upsert(self, type_, obj, index)
+            if '_key' in obj:
+                if r:
+                    self.coordinator.publish(key, r['id'])
+                else:
+                    self.coordinator.fail(key, 'shard %i could not upsert '
+                                          'it' % self.shard)
+            return r
+        elif '_key' not in obj:
+            # nothing in this shard needs it
+            return
+        try:
+            with self._stage(type_, index, 'lookup'):
+                return {'id': self.coordinator.wait(key, self.timeout)}
+        except ShardError as e:
+            self.logger.warning('no ID for %s %s: %s', type_.upper(), query,
+                                e)
+
+
+class SQLiteCoordinator(object):
+    """
+    Exchanges IDs through the SQLite database at `path`, which is created
+    if need be.  Each process (including ones forked after this is created)
+    opens its own connection.  Waiting polls the database.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # WAL lets shards read while another one writes; the schema is
+        # created in a write transaction, since shards may start together
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('BEGIN IMMEDIATE;' + SCHEMA + 'COMMIT;')
+
+    def __getstate__(self):
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    @property
+    def db(self):
+        if self._pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=60,
+                                 check_same_thread=False,
+                                 isolation_level=None)
+            self._db, self._pid = db, os.getpid()
+        return self._db
+
+    def publish(self, key, id):
+        with self._lock:
+            self.db.execute(
+                'INSERT OR IGNORE INTO ids (key, id, error) VALUES (?, ?, ?)',
+                (key, id, None))
+            self.db.execute(
+                'UPDATE ids SET id = ?, error = NULL '
+                'WHERE key = ? AND id IS NULL', (id, key))
+
+    def fail(self, key, error):
+        with self._lock:
+            self.db.execute(
+                'INSERT OR IGNORE INTO ids (key, id, error) VALUES (?, ?, ?)',
+                (key, None, error))
+
+    def wait(self, key, timeout=DEFAULT_TIMEOUT):
+        """
+        Returns the ID published for `key`, waiting up to `timeout` seconds
+        for it.  Raises `ShardError` if it fails or doesn't arrive.
+        """
+        deadline = time.time() + timeout
+        delay = 0.005
+        while True:
+            with self._lock:
+                row = self.db.execute(
+                    'SELECT id, error FROM ids WHERE key = ?',
+                    (key,)).fetchone()
+            if row is not None:
+                if row[1] is not None:
+                    raise ShardError(row[1])
+                return row[0]
+            if time.time() >= deadline:
+                raise ShardError('timed out waiting for %s' % key)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def close(self):
+        if self._db is not None and self._pid == os.getpid():
+            self._db.close()
+        self._db = None
+
+
+class SocketCoordinator(object):
+    """
+    Exchanges IDs through the `CoordinatorServer` at `address` (a
+    (host, port) tuple).  Requests and replies are lines of JSON.
+    """
+
+    def __init__(self, address):
+        self.address = tuple(address)
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return self.address
+
+    def __setstate__(self, address):
+        self.__init__(address)
+
+    def _request(self, **request):
+        with self._lock:
+            if self._pid != os.getpid():
+                sock = socket.create_connection(self.address)
+                self._connection = sock.makefile('r+b')
+                sock.close()
+                self._pid = os.getpid()
+            self._connection.write(json.dumps(request) + '\n')
+            self._connection.flush()
+            line = self._connection.readline()
+        if not line:
+            raise ShardError('lost the connection to %s:%i' % self.address)
+        return json.loads(line)
+
+    def publish(self, key, id):
+        self._request(op='publish', key=key, id=id)
+
+    def fail(self, key, error):
+        self._request(op='publish', key=key, error=error)
+
+    def wait(self, key, timeout=DEFAULT_TIMEOUT):
+        reply = self._request(op='wait', key=key, timeout=timeout)
+        if reply.get('error') is not None:
+            raise ShardError(reply['error'])
+        if reply.get('id') is None:
+            raise ShardError('timed out waiting for %s' % key)
+        return reply['id']
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+
+
+class CoordinatorHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        while True:
+            # not `for line in rfile`, which reads ahead
+            line = self.rfile.readline()
+            if not line:
+                return
+            request = json.loads(line)
+            key = request['key']
+            with server.condition:
+                if request['op'] == 'publish':
+                    # as with SQLiteCoordinator, an ID is never replaced
+                    current = server.ids.get(key)
+                    if current is None or (current[0] is None and
+                                           request.get('id') is not None):
+                        server.ids[key] = (request.get('id'),
+                                           request.get('error'))
+                        server.condition.notify_all()
+                    reply = {}
+                else:
+                    deadline = time.time() + request['timeout']
+                    while key not in server.ids:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        server.condition.wait(remaining)
+                    id, error = server.ids.get(key, (None, None))
+                    reply = dict(id=id, error=error)
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+
+class CoordinatorServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    Holds the published IDs in memory for `SocketCoordinator`s, with a
+    thread per connection.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address):
+        SocketServer.TCPServer.__init__(self, address, CoordinatorHandler)
+        self.ids = {}
+        self.condition = threading.Condition()
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def coordinator(address):
+    """
+    Returns a `SocketCoordinator` for 'tcp://HOST:PORT', and a
+    `SQLiteCoordinator` for anything else (a filename).
+    """
+    if address.startswith('tcp://'):
+        return SocketCoordinator(parse_address(address[len('tcp://'):]))
+    return SQLiteCoordinator(address)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit('usage: python -m studentrecord.sharding HOST:PORT')
+    server = CoordinatorServer(parse_address(sys.argv[1]))
+    print 'Coordinating on %s:%i' % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,44 @@
+"""
+Shared by the tests: puts the package, benchmarks/ and examples/ on the
+path, and runs the mock server (see benchmarks/mockserver.py).
+"""
+import json
+import os
+import sys
+import unittest
+from collections import Counter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+for path in ('', 'benchmarks', 'examples'):
+    sys.path.insert(0, os.path.join(ROOT, path))
+
+from mockserver import MockServer  # noqa
+
+ENDPOINTS = ('school', 'organization', 'person', 'applicant')
+
+
+def names(server, endpoint):
+    """
+    Counts the objects at `endpoint` on the mock server by name.
+    """
+    objects = server.store.objects(server.customer, endpoint).values()
+    return Counter(json.dumps(o.get('name'), sort_keys=True)
+                   for o in objects)
+
+
+class ServerTestCase(unittest.TestCase):
+
+    def server(self, latency=0.002, **kwargs):
+        """
+        Starts a mock server (stopped after the test), and returns it with
+        a client for its customer.  Other keyword arguments are passed to
+        the client.
+        """
+        server = MockServer(latency=latency)
+        server.start()
+        self.addCleanup(server.stop)
+        sr = server.client(**kwargs)
+        # close its connections before the server stops
+        self.addCleanup(sr.session.close)
+        sr.choose_customer(server.customer)
+        return server, sr
@@ -0,0 +1,80 @@
+"""
+How `to_arrays` types its columns, against the mock server:
+
+    python -m unittest discover tests
+"""
+import unittest
+
+from support import ServerTestCase
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'needs numpy')
+class ColumnTypeTest(ServerTestCase):
+
+    def arrays(self, *values):
+        """
+        Creates an object per value (missing where it's None), and returns
+        the 'value' column.
+        """
+        server, sr = self.server(latency=0)
+        for value in values:
+            obj = dict(name='object')
+            if value is not None:
+                obj['value'] = value
+            sr['school'].create(obj)
+        arrays = sr['school'].to_arrays(size=1)
+        self.assertEqual(len(arrays['id']), len(values))
+        return arrays['value']
+
+    def test_integers(self):
+        big = 2 ** 53 + 1
+        column = self.arrays(1, big, 3.0)
+        self.assertEqual(column.dtype, 'int64')
+        self.assertEqual(column.tolist(), [1, big, 3])
+
+    def test_fractions(self):
+        column = self.arrays(1, 2.5, None)
+        self.assertEqual(column.dtype, 'float64')
+        self.assertEqual(column[:2].tolist(), [1.0, 2.5])
+        self.assertTrue(numpy.isnan(column[2]))
+
+    def test_no_rounding(self):
+        big = 2 ** 53 + 1
+        # a float64 would round these, so they stay as they are
+        self.assertEqual(self.arrays(big, None).tolist(), [big, None])
+        self.assertEqual(self.arrays(big, 2.5).tolist(), [big, 2.5])
+        self.assertEqual(self.arrays(2.5, big).tolist(), [2.5, big])
+        self.assertEqual(self.arrays(1, 2 ** 64).tolist(), [1, 2 ** 64])
+
+    def test_booleans(self):
+        self.assertEqual(self.arrays(True, False).dtype, bool)
+        self.assertEqual(self.arrays(True, None).tolist(), [True, None])
+
+    def test_datetimes(self):
+        column = self.arrays('2020-02-28', None, '2020-02-29T12:30')
+        self.assertEqual(column.dtype, 'datetime64[us]')
+        self.assertEqual(
+            column.astype(str).tolist(),
+            ['2020-02-28T00:00:00.000000', 'NaT',
+             '2020-02-29T12:30:00.000000'])
+
+    def test_invalid_datetimes(self):
+        for invalid in ('0000-00-00', '2020-02-30'):
+            column = self.arrays('2020-02-28', invalid, None)
+            self.assertEqual(column.tolist(), ['2020-02-28', invalid, None])
+
+    def test_mixed(self):
+        self.assertEqual(self.arrays('2020-02-28', 'soon').tolist(),
+                         ['2020-02-28', 'soon'])
+        self.assertEqual(self.arrays(1, 'one', None).tolist(),
+                         [1, 'one', None])
+        self.assertEqual(self.arrays(1, True).tolist(), [1, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
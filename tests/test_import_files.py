@@ -0,0 +1,61 @@
+"""
+Multi-file imports with -j, against the mock server:
+
+    python -m unittest discover tests
+"""
+import unittest
+from collections import Counter
+
+from support import ENDPOINTS, ServerTestCase, names
+from studentrecord.importer import Importer
+from studentrecord.profiling import Profile
+from csv_import import import_files, read_csv
+from endtoend import load_mappings, synthetic_csv
+
+
+def overlapping_files():
+    # the same file twice, and one whose schools and employers overlap it
+    return [synthetic_csv(60), synthetic_csv(60), synthetic_csv(60, seed=1)]
+
+
+class ImportFilesTest(ServerTestCase):
+
+    def test_threads_share_objects(self):
+        server, sr = self.server(pool_size=16)
+        importer = Importer(sr, load_mappings(), coalesce=True)
+        import_files(importer, overlapping_files(), threads=8, quiet=2)
+        for endpoint in ENDPOINTS:
+            duplicates = [n for (n, count) in names(server, endpoint).items()
+                          if count > 1]
+            self.assertEqual(duplicates, [], endpoint)
+
+        expected, sr = self.server()
+        importer = Importer(sr, load_mappings())
+        for f in overlapping_files():
+            importer(read_csv(f)[1])
+        for endpoint in ENDPOINTS:
+            self.assertEqual(names(server, endpoint),
+                             names(expected, endpoint), endpoint)
+
+    def test_profile_counts_each_threads_requests(self):
+        server, sr = self.server(pool_size=16)
+        profile = Profile()
+        importer = Importer(sr, load_mappings(), coalesce=True,
+                            profile=profile)
+        methods = Counter()
+
+        def record(info):
+            methods[info['method']] += 1
+        sr.add_hook('post_request', record)
+        import_files(importer, overlapping_files(), threads=8, quiet=2)
+        requests = Counter()
+        for row in profile.summary():
+            requests[row['stage']] += row['requests']
+        self.assertEqual(profile.requests, sum(methods.values()))
+        self.assertEqual(sum(requests.values()), profile.requests)
+        self.assertEqual(requests['lookup'], methods['get'])
+        self.assertEqual(requests['write'], methods['post'] + methods['put'])
+
+
+if __name__ == '__main__':
+    unittest.main()
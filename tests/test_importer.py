@@ -0,0 +1,71 @@
+"""
+The coalescing importer, against the mock server:
+
+    python -m unittest discover tests
+"""
+import unittest
+from collections import Counter
+
+from support import ServerTestCase
+from studentrecord.importer import Importer
+from endtoend import load_mappings, synthetic_rows
+
+ROWS = 100
+
+
+def moved(rows):
+    # every school moves, so each is updated once however many rows it's in
+    for row in rows:
+        row['Sec School/College City'] = 'Cambridge'
+        yield row
+
+
+class CoalesceTest(ServerTestCase):
+
+    def setUp(self):
+        self.server, self.sr = self.server(latency=0)
+        Importer(self.sr, load_mappings())(list(synthetic_rows(ROWS)))
+
+    def import_rows(self, rows, **kwargs):
+        importer = Importer(self.sr, load_mappings(), coalesce=True,
+                            **kwargs)
+        largest = 0
+        for row in rows:
+            importer(row)
+            largest = max(largest, importer.cache_sizes()['objects'])
+        importer.flush()
+        return importer, largest
+
+    def test_cache_is_bounded(self):
+        importer, largest = self.import_rows(synthetic_rows(ROWS),
+                                             cache_size=50)
+        self.assertEqual(largest, 50)
+        self.assertEqual(importer.cache_sizes(),
+                         dict(objects=50, pending=0))
+
+    def test_cache_is_bounded_with_changes(self):
+        importer, largest = self.import_rows(moved(synthetic_rows(ROWS)),
+                                             cache_size=50, chunk_size=10)
+        # objects with unwritten changes are kept until they're written
+        self.assertLessEqual(largest, 50 + 10)
+
+    def test_each_object_written_once(self):
+        puts = Counter()
+
+        def record(info):
+            if info['method'] == 'put':
+                puts[info['endpoint'], info['url']] += 1
+        self.sr.add_hook('post_request', record)
+        self.import_rows(moved(synthetic_rows(ROWS)), cache_size=50,
+                         chunk_size=10)
+        schools = [o for o in self.server.store.objects(
+            self.server.customer, 'school').values() if 'location' in o]
+        written = [url for (endpoint, url) in puts if endpoint == 'school']
+        self.assertEqual(len(written), len(schools))
+        self.assertEqual(set(puts.values()), set([1]))
+        for school in schools:
+            self.assertEqual(school['location']['city'], 'Cambridge')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+Sharded imports, against the mock server:
+
+    python -m unittest discover tests
+"""
+import cPickle as pickle
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from support import ENDPOINTS, ServerTestCase, names
+from studentrecord.importer import Importer
+from studentrecord.sharding import (
+    CoordinatorServer, ShardError, ShardedImporter, SocketCoordinator,
+    SQLiteCoordinator)
+from csv_import import import_shard, wait_for_shards
+from endtoend import load_mappings, synthetic_rows
+
+
+def sleep_then_exit(seconds, status):
+    time.sleep(seconds)
+    sys.exit(status)
+
+
+class ShardedImportTest(ServerTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_same_objects_as_unsharded(self):
+        rows = list(synthetic_rows(80))
+        server, sr = self.server()
+        address = os.path.join(self.directory, 'coordination.db')
+        processes = []
+        for shard in range(4):
+            importer = ShardedImporter(
+                sr, load_mappings(), shard=shard, shards=4,
+                coordinator=SQLiteCoordinator(address))
+            importer.logger = None
+            processes.append(multiprocessing.Process(
+                target=import_shard,
+                args=(pickle.dumps(importer, pickle.HIGHEST_PROTOCOL),
+                      'CRITICAL', rows)))
+        for process in processes:
+            process.start()
+        self.assertEqual(wait_for_shards(processes), ([], []))
+
+        expected, sr = self.server()
+        Importer(sr, load_mappings())(list(synthetic_rows(80)))
+        for endpoint in ENDPOINTS:
+            self.assertEqual(names(server, endpoint),
+                             names(expected, endpoint), endpoint)
+        # every applicant refers to its school and parent
+        for applicant in server.store.objects(server.customer,
+                                              'applicant').values():
+            self.assertTrue(applicant['schools'][0].get('school'))
+            self.assertTrue(applicant['family'][0].get('person'))
+
+    def test_failed_shard_stops_the_others(self):
+        processes = [
+            multiprocessing.Process(target=sleep_then_exit, args=(0, 1)),
+            multiprocessing.Process(target=sleep_then_exit, args=(60, 0))]
+        for process in processes:
+            process.start()
+        start = time.time()
+        self.assertEqual(wait_for_shards(processes), ([0], [1]))
+        self.assertLess(time.time() - start, 30)
+
+
+class CoordinatorTest(unittest.TestCase):
+
+    def check_publish_once(self, coordinator):
+        coordinator.publish('a', '1')
+        coordinator.fail('a', 'failed later')
+        coordinator.publish('a', '2')
+        self.assertEqual(coordinator.wait('a', 1), '1')
+        coordinator.fail('b', 'failed')
+        self.assertRaises(ShardError, coordinator.wait, 'b', 1)
+        coordinator.publish('b', '3')
+        self.assertEqual(coordinator.wait('b', 1), '3')
+
+    def test_sqlite(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        coordinator = SQLiteCoordinator(os.path.join(directory, 'ids.db'))
+        self.addCleanup(coordinator.close)
+        self.check_publish_once(coordinator)
+
+    def test_socket(self):
+        server = CoordinatorServer(('127.0.0.1', 0))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        coordinator = SocketCoordinator(server.server_address)
+        self.addCleanup(coordinator.close)
+        self.check_publish_once(coordinator)
+
+
+if __name__ == '__main__':
+    unittest.main()